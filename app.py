@@ -1,33 +1,514 @@
-from flask import Flask, render_template, request, redirect, session, Response, jsonify
+from flask import Flask, render_template, request, redirect, session, Response, jsonify, g, has_request_context, stream_with_context
+from werkzeug.routing import IntegerConverter
 import psycopg2
+import psycopg2.errors
+import psycopg2.extensions
+from psycopg2 import pool
 import hashlib
 from datetime import datetime, timezone, timedelta
+from contextlib import contextmanager
+from collections import OrderedDict, Counter
+import bisect
 import html
 import re
 import json 
 import time 
 import os
+import threading
+import queue
+import select
+import migrations
+
+try:
+    import orjson  # optional: pip install orjson for a faster /api/feed
+except ImportError:
+    orjson = None
+
+# Ids are INTEGER columns, and the prepared statements declare their id
+# parameters the same way, so a larger value would fail with "integer out of
+# range" instead of matching nothing
+MAX_ID = 2 ** 31 - 1
+
+class IdConverter(IntegerConverter):
+    # Every <int:...> in the routes is a row id: out-of-range ones are a 404
+    def __init__(self, map, *args, **kwargs):
+        kwargs.setdefault("max", MAX_ID)
+        super().__init__(map, *args, **kwargs)
 
 app = Flask(__name__)
+app.url_map.converters["int"] = IdConverter
 # Get secret key from environment variable in Vercel, fallback to default for local dev
 app.secret_key = os.getenv("SECRET_KEY", "super_secret_key") 
 
 # --- DATABASE SETUP ---
 DATABASE_URL = os.getenv("DATABASE_URL")
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+DB_POOL_WAIT = float(os.getenv("DB_POOL_WAIT", "10"))  # seconds to wait for a free connection
+
+# Optional streaming replica. Read-only handlers use it through get_read_db()
+# unless the user just wrote something or the replica is down or behind.
+DATABASE_READ_URL = os.getenv("DATABASE_READ_URL")
+DB_READ_POOL_MAX = int(os.getenv("DB_READ_POOL_MAX", str(DB_POOL_MAX)))
+READ_STICKY_SECONDS = float(os.getenv("READ_STICKY_SECONDS", "5"))
+REPLICA_MAX_LAG = float(os.getenv("REPLICA_MAX_LAG", "2"))  # seconds
+REPLICA_CHECK_INTERVAL = 1  # seconds between lag probes per process
+REPLICA_RETRY = 30  # seconds to stay on the primary after a failed connect
+
+# "primary" / "replica" -> ThreadedConnectionPool
+_db_pools = {}
+_db_pool_lock = threading.Lock()
+# The pools raise as soon as they are empty; these make bursts of requests
+# queue for a connection instead (matters under gevent, where hundreds can overlap)
+_db_slots = {
+    "primary": threading.BoundedSemaphore(DB_POOL_MAX),
+    "replica": threading.BoundedSemaphore(DB_READ_POOL_MAX)
+}
+
+def get_pool(role="primary"):
+    # Created lazily so importing the app doesn't need a reachable database.
+    # Locked because opening the first connection can yield (gevent), and two
+    # first requests must not each build their own pool
+    if role not in _db_pools:
+        with _db_pool_lock:
+            if role not in _db_pools:
+                primary = role == "primary"
+                _db_pools[role] = pool.ThreadedConnectionPool(
+                    DB_POOL_MIN,
+                    DB_POOL_MAX if primary else DB_READ_POOL_MAX,
+                    DATABASE_URL if primary else DATABASE_READ_URL,
+                    connection_factory=AppConnection,
+                    cursor_factory=InstrumentedCursor
+                )
+    return _db_pools[role]
+
+def acquire_conn(role="primary"):
+    if not _db_slots[role].acquire(timeout=DB_POOL_WAIT):
+        raise pool.PoolError("timed out waiting for a database connection")
+    try:
+        return get_pool(role).getconn()
+    except Exception:
+        _db_slots[role].release()
+        raise
+
+def release_conn(db, role="primary"):
+    # Anything left uncommitted is thrown away so the next borrower starts clean
+    broken = bool(db.closed)
+    if not broken:
+        try:
+            db.rollback()
+        except psycopg2.Error:
+            broken = True
+    try:
+        get_pool(role).putconn(db, close=broken)
+    finally:
+        _db_slots[role].release()
 
 def get_db():
-    return psycopg2.connect(DATABASE_URL)
+    # One pooled connection per request, shared by the route and every helper it calls
+    if "db" not in g:
+        g.db = acquire_conn()
+        if "db_stats" in g:
+            g.db_stats["connections"] += 1
+    return g.db
+
+# down_until: monotonic time before which the replica is skipped
+# checked_at / lagging: result of the last lag probe
+_replica = {"down_until": 0.0, "checked_at": 0.0, "lagging": False}
+
+def replica_lagging(db):
+    if time.monotonic() - _replica["checked_at"] >= REPLICA_CHECK_INTERVAL:
+        cur = db.cursor()
+        # Fully replayed counts as no lag; an idle primary would otherwise
+        # look further behind every second
+        cur.execute("""
+            SELECT CASE
+                WHEN NOT pg_is_in_recovery() THEN 0
+                WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+            END
+        """)
+        lag = cur.fetchone()[0]
+        _replica["lagging"] = lag is None or lag > REPLICA_MAX_LAG
+        _replica["checked_at"] = time.monotonic()
+    return _replica["lagging"]
+
+def connection_dead(db):
+    # An idle pooled connection has nothing to read unless the server went
+    # away (restart, terminated backend) and left a FATAL notice or EOF.
+    # Costs no round trip, unlike a ping.
+    if db.closed:
+        return True
+    try:
+        return bool(select.select([db], [], [], 0)[0])
+    except (OSError, ValueError):
+        return True
+
+def recently_wrote(within=READ_STICKY_SECONDS):
+    return time.time() - session.get("wrote_at", 0) < within
+
+def feed_stale_for_viewer():
+    # Another worker's cached public page can predate this viewer's own post
+    # by up to FEED_CACHE_TTL, so their feed loads skip it for that long
+    return recently_wrote(max(READ_STICKY_SECONDS, FEED_CACHE_TTL))
+
+def get_read_db():
+    # For read-only handlers: the replica when it's configured, reachable and
+    # caught up, and the user hasn't written in the last READ_STICKY_SECONDS
+    # (so they always see their own changes). Otherwise the primary.
+    if "read_db" in g:
+        return g.read_db
+
+    db = None
+    if DATABASE_READ_URL and not recently_wrote() and time.monotonic() >= _replica["down_until"]:
+        try:
+            db = acquire_conn("replica")
+        except pool.PoolError:
+            pass  # replica pool saturated; this request reads from the primary
+        except psycopg2.Error:
+            app.logger.warning("replica unreachable, reading from the primary for %ss", REPLICA_RETRY)
+            _replica["down_until"] = time.monotonic() + REPLICA_RETRY
+
+    if db is not None and connection_dead(db):
+        # Pooled before the replica restarted; release_conn closes it
+        release_conn(db, "replica")
+        db = None
+
+    if db is not None:
+        try:
+            usable = not replica_lagging(db)
+        except psycopg2.Error:
+            _replica["down_until"] = time.monotonic() + REPLICA_RETRY
+            usable = False
+        if not usable:
+            release_conn(db, "replica")
+            db = None
+
+    if db is None:
+        g.read_db = get_db()
+    else:
+        g.read_db = db
+        g.read_from_replica = True
+        if "db_stats" in g:
+            g.db_stats["connections"] += 1
+    return g.read_db
+
+@app.after_request
+def remember_write(response):
+    # Starts the read-your-writes window, for the replica and for the shared
+    # feed cache; GET handlers that write set g.wrote
+    if (DATABASE_READ_URL or FEED_CACHE_TTL > 0) and "user_id" in session and response.status_code < 400:
+        if request.method == "POST" or g.get("wrote"):
+            session["wrote_at"] = time.time()
+    return response
+
+@app.teardown_appcontext
+def teardown_db(exc=None):
+    read_db = g.pop("read_db", None)
+    if read_db is not None and g.pop("read_from_replica", False):
+        release_conn(read_db, "replica")
+    db = g.pop("db", None)
+    if db is not None:
+        release_conn(db)
+
+def release_request_db():
+    # Hands the request's connections back before teardown, e.g. ahead of a
+    # streamed body; a later get_db() or get_read_db() borrows again
+    teardown_db()
+
+@contextmanager
+def pooled_db():
+    # For code running outside a request (e.g. SSE generators)
+    db = acquire_conn()
+    try:
+        yield db
+    finally:
+        release_conn(db)
+
+# --- PREPARED STATEMENTS ---
+# The hot handlers run their SQL through named server-side prepared
+# statements, so each pooled connection parses and plans a statement once
+# instead of on every request. Set PREPARE_STATEMENTS=0 behind a pooler
+# that doesn't keep server sessions (pgbouncer in transaction mode).
+PREPARE_STATEMENTS = os.getenv("PREPARE_STATEMENTS", "1") == "1"
+
+PREPARED = {}
+
+class AppConnection(psycopg2.extensions.connection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Statement names PREPAREd on this session. None means the session
+        # was reset under us and may hold some of them, so start over.
+        self.prepared = set()
+
+def register_statement(name, sql, example, **types):
+    """Adds `sql`, written with %(name)s placeholders, to the registry.
+    `types` gives each placeholder's PostgreSQL type in parameter order;
+    `example` holds representative values that `flask check-plans` runs the
+    statement's plan with."""
+    order = list(types)
+    positional = re.sub(
+        r"%\((\w+)\)s", lambda m: f"${order.index(m.group(1)) + 1}", sql
+    ).replace("%%", "%")
+    signature = f" ({', '.join(types.values())})" if types else ""
+    PREPARED[name] = {
+        "sql": sql,
+        "prepare": f"PREPARE {name}{signature} AS {positional}",
+        "execute": f"EXECUTE {name}" + (f" ({', '.join(f'%({p})s' for p in order)})" if order else ""),
+        "types": list(types.values()),
+        "positional": positional,
+        "example": [example[p] for p in order]
+    }
+
+def execute_prepared(cur, name, params, retry=True):
+    statement = PREPARED[name]
+    db = cur.connection
+    known = getattr(db, "prepared", False)
+    # Connections from a pool built without AppConnection run the plain SQL
+    if not PREPARE_STATEMENTS or known is False:
+        return cur.execute(statement["sql"], params)
+
+    idle = db.info.transaction_status == psycopg2.extensions.TRANSACTION_STATUS_IDLE
+    try:
+        if known is None:
+            cur.execute("DEALLOCATE ALL")
+            db.prepared = known = set()
+        if name not in known:
+            cur.execute(statement["prepare"])
+            known.add(name)
+        return cur.execute(statement["execute"], params)
+    except (psycopg2.errors.InvalidSqlStatementName, psycopg2.errors.DuplicatePreparedStatement):
+        # The server session was recycled (DISCARD ALL, a pooler swapping
+        # backends). Nothing is lost if this was the transaction's first
+        # statement, so prepare again; otherwise the caller's transaction is
+        # already aborted and only the next one can recover.
+        db.prepared = None
+        if not (idle and retry):
+            raise
+        db.rollback()
+        return execute_prepared(cur, name, params, retry=False)
+
+# --- QUERY INSTRUMENTATION ---
+# Every pooled cursor reports to the current request's g.db_stats; after the
+# request the totals go out as a Server-Timing header and into per-route
+# histograms served at /admin/metrics.
+REPEATED_QUERY_THRESHOLD = int(os.getenv("REPEATED_QUERY_THRESHOLD", "5"))
+SLOWEST_KEPT = 5
+LATENCY_BUCKETS_MS = [1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500]
+QUERY_BUCKETS = [0, 1, 2, 3, 5, 10, 20, 50, 100]
+
+_route_metrics = {}
+_metrics_lock = threading.Lock()
+
+class InstrumentedCursor(psycopg2.extensions.cursor):
+    def execute(self, query, vars=None):
+        started = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            if has_request_context() and "db_stats" in g:
+                record_query(g.db_stats, query, time.perf_counter() - started)
+
+def new_db_stats():
+    return {
+        "queries": 0,
+        "connections": 0,
+        "seconds": 0.0,
+        "statements": Counter(),
+        "slowest": []
+    }
+
+def statement_text(query):
+    if isinstance(query, bytes):
+        query = query.decode("utf-8", "replace")
+    return " ".join(str(query).split())[:300]
+
+def record_query(stats, query, elapsed):
+    stats["queries"] += 1
+    stats["seconds"] += elapsed
+    stats["statements"][query] += 1
+
+    slowest = stats["slowest"]
+    if len(slowest) < SLOWEST_KEPT or elapsed > slowest[-1][0]:
+        slowest.append((elapsed, query))
+        slowest.sort(key=lambda s: s[0], reverse=True)
+        del slowest[SLOWEST_KEPT:]
+
+@app.before_request
+def start_db_stats():
+    g.request_started = time.perf_counter()
+    g.db_stats = new_db_stats()
+
+@app.after_request
+def finish_db_stats(response):
+    stats = g.get("db_stats")
+    if stats is None:
+        return response
+
+    started = g.request_started
+    route = f"{request.method} {request.url_rule.rule if request.url_rule else request.path}"
+
+    response.headers["Server-Timing"] = (
+        f'db;dur={stats["seconds"] * 1000:.2f};desc="{stats["queries"]} queries, {stats["connections"]} conn", '
+        f'app;dur={(time.perf_counter() - started) * 1000:.2f}'
+    )
+    if g.get("streamed_stats"):
+        # The body still runs queries after the headers go out; the header
+        # can only show what ran before, the route metrics get everything
+        response.call_on_close(lambda: record_route_stats(route, stats, started))
+    else:
+        record_route_stats(route, stats, started)
+    return response
+
+def record_route_stats(route, stats, started):
+    total_ms = (time.perf_counter() - started) * 1000
+    db_ms = stats["seconds"] * 1000
+    # Same SQL text over and over in one request is the N+1 signature
+    repeated = [
+        (statement_text(sql), n)
+        for sql, n in stats["statements"].items()
+        if n >= REPEATED_QUERY_THRESHOLD
+    ]
+    for sql, n in repeated:
+        app.logger.warning("%s ran the same statement %d times: %s", route, n, sql)
+
+    with _metrics_lock:
+        m = _route_metrics.get(route)
+        if m is None:
+            m = _route_metrics[route] = {
+                "requests": 0,
+                "queries": 0,
+                "connections": 0,
+                "db_ms": 0.0,
+                "max_queries": 0,
+                "repeated_statement_requests": 0,
+                "latency_ms": [0] * (len(LATENCY_BUCKETS_MS) + 1),
+                "queries_per_request": [0] * (len(QUERY_BUCKETS) + 1),
+                "slowest": [],
+                "repeated": {}
+            }
+        m["requests"] += 1
+        m["queries"] += stats["queries"]
+        m["connections"] += stats["connections"]
+        m["db_ms"] += db_ms
+        m["max_queries"] = max(m["max_queries"], stats["queries"])
+        m["latency_ms"][bisect.bisect_left(LATENCY_BUCKETS_MS, total_ms)] += 1
+        m["queries_per_request"][bisect.bisect_left(QUERY_BUCKETS, stats["queries"])] += 1
+        if repeated:
+            m["repeated_statement_requests"] += 1
+            for sql, n in repeated:
+                m["repeated"][sql] = max(m["repeated"].get(sql, 0), n)
+
+        slowest = m["slowest"]
+        for elapsed, sql in stats["slowest"]:
+            if len(slowest) < SLOWEST_KEPT or elapsed * 1000 > slowest[-1]["ms"]:
+                slowest.append({"ms": round(elapsed * 1000, 3), "sql": statement_text(sql)})
+        slowest.sort(key=lambda s: s["ms"], reverse=True)
+        del slowest[SLOWEST_KEPT:]
+
+# --- CONDITIONAL GET ---
+# Polled JSON endpoints look up a cheap version first (revision counters from
+# migration 7, conversation summaries) and answer 304 when the client already
+# holds it, skipping the payload queries entirely. Browsers send
+# If-None-Match on their own for fetch() calls.
+def make_etag(*parts):
+    return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+def tagged(response, etag):
+    response.set_etag(etag)
+    # Per-viewer data: keep it private and revalidate on every use
+    response.headers["Cache-Control"] = "private, no-cache"
+    response.vary.add("Cookie")
+    return response
+
+def not_modified(etag):
+    if etag in request.if_none_match:
+        return tagged(Response(status=304), etag)
+    return None
 
 def hash_password(password):
     return hashlib.sha256(password.encode()).hexdigest()
 
+ADMIN_USERNAME = "Raulnistel"
+
+# --- USER IDENTITY CACHE ---
+USER_CACHE_TTL = int(os.getenv("USER_CACHE_TTL", "60"))
+USER_CACHE_SIZE = 4096
+
+# user_id -> (expires_at, {id, username, is_muted, is_deleted}), least recently
+# used first. Renames, mutes and deletions call forget_user() in this process;
+# the TTL bounds how long other workers can keep a stale answer.
+_user_cache = OrderedDict()
+_user_ids_by_name = {}
+_user_cache_lock = threading.Lock()
+
+def _drop_cached_user(user_id):
+    entry = _user_cache.pop(user_id, None)
+    if entry and _user_ids_by_name.get(entry[1]["username"]) == user_id:
+        del _user_ids_by_name[entry[1]["username"]]
+
+def cache_user(row):
+    user = {
+        "id": row[0],
+        "username": row[1],
+        "is_muted": bool(row[2]),
+        "is_deleted": bool(row[3])
+    }
+    with _user_cache_lock:
+        _drop_cached_user(user["id"])
+        _user_cache[user["id"]] = (time.monotonic() + USER_CACHE_TTL, user)
+        if user["username"] is not None:
+            _user_ids_by_name[user["username"]] = user["id"]
+        while len(_user_cache) > USER_CACHE_SIZE:
+            _drop_cached_user(next(iter(_user_cache)))
+    return user
+
+def cached_user(user_id):
+    with _user_cache_lock:
+        entry = _user_cache.get(user_id)
+        if entry is None:
+            return None
+        if entry[0] <= time.monotonic():
+            _drop_cached_user(user_id)
+            return None
+        _user_cache.move_to_end(user_id)
+        return entry[1]
+
+register_statement("user_by_id", """
+    SELECT id, username, is_muted, is_deleted FROM users WHERE id = %(user)s
+""", {"user": 1}, user="integer")
+
+register_statement("user_by_name", """
+    SELECT id, username, is_muted, is_deleted FROM users WHERE username = %(username)s
+""", {"username": "bob"}, username="text")
+
+def get_user(user_id):
+    user = cached_user(user_id)
+    if user is None:
+        cur = get_db().cursor()
+        execute_prepared(cur, "user_by_id", {"user": user_id})
+        row = cur.fetchone()
+        user = cache_user(row) if row else None
+    return user
+
+def get_user_by_name(username):
+    with _user_cache_lock:
+        user_id = _user_ids_by_name.get(username)
+    user = cached_user(user_id) if user_id is not None else None
+    if user is None or user["username"] != username:
+        cur = get_db().cursor()
+        execute_prepared(cur, "user_by_name", {"username": username})
+        row = cur.fetchone()
+        user = cache_user(row) if row else None
+    return user
+
+def forget_user(user_id):
+    with _user_cache_lock:
+        _drop_cached_user(user_id)
+
 def is_admin_user(user_id):
-    db = get_db()
-    cur = db.cursor()
-    cur.execute("SELECT username FROM users WHERE id=%s", (user_id,))
-    row = cur.fetchone()
-    db.close()
-    return row and row[0] == "Raulnistel"
+    user = get_user(user_id)
+    return bool(user and user["username"] == ADMIN_USERNAME)
 
 @app.route("/", methods=["GET", "POST"])
 def login():
@@ -43,7 +524,6 @@ def login():
         )
 
         user = cur.fetchone()
-        db.close()
 
         if user:
             session["user_id"] = user[0]
@@ -65,7 +545,6 @@ def signup():
 
         cur.execute("SELECT 1 FROM users WHERE username=%s", (username,))
         if cur.fetchone():
-            db.close()
             return render_template("signup.html", error="Username already exists")
 
         cur.execute(
@@ -74,11 +553,60 @@ def signup():
         )
 
         db.commit()
-        db.close()
+        clear_search_cache()
         return redirect("/")
 
     return render_template("signup.html")
 
+PREVIEW_LENGTH = 100
+
+def touch_conversation(cur, sender_id, receiver_id, msg_id, content):
+    # One row per participant, so each side's DM list is a single index scan
+    rows = [(sender_id, receiver_id, 0)]
+    if receiver_id != sender_id:
+        rows.append((receiver_id, sender_id, 1))
+
+    preview = content[:PREVIEW_LENGTH]
+    for user_id, partner_id, unread in rows:
+        cur.execute("""
+            INSERT INTO conversations
+                (user_id, partner_id, last_message_id, last_preview, last_at, unread_count)
+            VALUES (%s, %s, %s, %s, now(), %s)
+            ON CONFLICT (user_id, partner_id) DO UPDATE SET
+                last_message_id = EXCLUDED.last_message_id,
+                last_preview = EXCLUDED.last_preview,
+                last_at = EXCLUDED.last_at,
+                unread_count = conversations.unread_count + EXCLUDED.unread_count
+        """, (user_id, partner_id, msg_id, preview, unread))
+
+def rebuild_conversations():
+    # Backfills conversations from the full message history
+    db = get_db()
+    cur = db.cursor()
+    cur.execute("DELETE FROM conversations")
+    cur.execute("""
+        INSERT INTO conversations
+            (user_id, partner_id, last_message_id, last_preview, last_at, unread_count)
+        SELECT DISTINCT ON (pair.user_id, pair.partner_id)
+            pair.user_id, pair.partner_id, m.id, LEFT(m.content, %s), m.created_at, 0
+        FROM (
+            SELECT id, sender_id AS user_id, receiver_id AS partner_id FROM messages
+            UNION ALL
+            SELECT id, receiver_id, sender_id FROM messages
+        ) pair
+        JOIN messages m ON m.id = pair.id
+        WHERE pair.user_id != pair.partner_id
+        ORDER BY pair.user_id, pair.partner_id, m.id DESC
+    """, (PREVIEW_LENGTH,))
+    count = cur.rowcount
+    db.commit()
+    return count
+
+@app.cli.command("rebuild-conversations")
+def rebuild_conversations_command():
+    """Rebuild the DM conversation summaries from the messages table."""
+    print(f"rebuilt {rebuild_conversations()} conversations")
+
 @app.route("/api/send_message", methods=["POST"])
 def send_message():
     if "user_id" not in session:
@@ -90,15 +618,145 @@ def send_message():
     if not receiver_id or not content:
         return {"error": "missing data"}, 400
 
+    try:
+        receiver_id = int(receiver_id)
+    except ValueError:
+        return {"error": "missing data"}, 400
+
     db = get_db()
     cur = db.cursor()
     cur.execute(
-        "INSERT INTO messages (sender_id, receiver_id, content) VALUES (%s, %s, %s)",
+        "INSERT INTO messages (sender_id, receiver_id, content) VALUES (%s, %s, %s) RETURNING id",
         (session["user_id"], receiver_id, content)
     )
+    msg_id = cur.fetchone()[0]
+    touch_conversation(cur, session["user_id"], receiver_id, msg_id, content)
+    # Delivered to listeners only once the transaction commits
+    cur.execute(
+        "SELECT pg_notify(%s, %s)",
+        (MESSAGE_CHANNEL, json.dumps({
+            "id": msg_id,
+            "receiver_id": receiver_id,
+            "sender": session["username"]
+        }))
+    )
     db.commit()
-    db.close()
-    return {"success": True}
+
+    # The message is already delivered, so failing here must not turn into
+    # an error the client would retry. A missed partition is created by the
+    # next send or by `flask message-partitions`.
+    try:
+        # Gives up rather than queue every messages reader behind the DDL
+        if ensure_message_partitions(cur, msg_id, lock_timeout="2s"):
+            db.commit()
+    except psycopg2.Error:
+        db.rollback()
+        _message_partitions["ready"] = -1
+        app.logger.warning("could not create message partitions after id %s", msg_id, exc_info=True)
+    return {"success": True, "id": msg_id}
+
+# --- MESSAGE PARTITIONS ---
+# messages is range-partitioned on id (migration 9). The partition after the
+# one currently filling is created ahead of time, so inserts never find
+# nowhere to land. Old partitions stay attached and readable; archiving
+# freezes them and can move them to slower or compressed storage.
+MESSAGE_PARTITION_SIZE = migrations.MESSAGE_PARTITION_SIZE
+MESSAGE_ARCHIVE_DAYS = int(os.getenv("MESSAGE_ARCHIVE_DAYS", "180"))
+# e.g. a tablespace on a compressed filesystem; unset keeps partitions in place
+MESSAGE_ARCHIVE_TABLESPACE = os.getenv("MESSAGE_ARCHIVE_TABLESPACE")
+
+# Highest partition number this process knows exists
+_message_partitions = {"ready": -1}
+
+def message_partitions(cur):
+    # [(number, table name, archived)] in id order
+    cur.execute("""
+        SELECT c.relname, COALESCE('autovacuum_enabled=false' = ANY(c.reloptions), FALSE)
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'messages'::regclass
+    """)
+    return sorted(
+        (int(name[len("messages_p"):]), name, archived)
+        for name, archived in cur.fetchall()
+        if re.fullmatch(r"messages_p\d+", name)
+    )
+
+def ensure_message_partitions(cur, up_to_id, lock_timeout=None):
+    # Creates any missing partition up to the one after up_to_id's. Returns
+    # whether it ran DDL that the caller must commit. Creating a partition
+    # locks the whole messages table; lock_timeout bounds the wait for it.
+    wanted = up_to_id // MESSAGE_PARTITION_SIZE + 1
+    if wanted <= _message_partitions["ready"]:
+        return False
+
+    existing = {n for n, _, _ in message_partitions(cur)}
+    created = False
+    for n in range(wanted + 1):
+        if n in existing:
+            continue
+        if lock_timeout and not created:
+            cur.execute("SET LOCAL lock_timeout = %s", (lock_timeout,))
+        cur.execute(
+            f"CREATE TABLE IF NOT EXISTS messages_p{n} PARTITION OF messages "
+            f"FOR VALUES FROM ({n * MESSAGE_PARTITION_SIZE}) TO ({(n + 1) * MESSAGE_PARTITION_SIZE})"
+        )
+        created = True
+    _message_partitions["ready"] = wanted
+    return created
+
+def archive_message_partitions():
+    # Freezes every partition whose newest message is older than
+    # MESSAGE_ARCHIVE_DAYS, turns autovacuum off for it (nothing writes there
+    # again) and moves it and its indexes to MESSAGE_ARCHIVE_TABLESPACE if set.
+    # Returns the archived table names.
+    db = get_db()
+    cur = db.cursor()
+    cutoff = datetime.now(timezone.utc) - timedelta(days=MESSAGE_ARCHIVE_DAYS)
+
+    cold = []
+    for n, name, archived in message_partitions(cur):
+        if archived:
+            continue
+        cur.execute(f"SELECT created_at FROM {name} ORDER BY id DESC LIMIT 1")
+        row = cur.fetchone()
+        # Empty partitions are the spares waiting for new ids
+        if row and row[0] < cutoff:
+            cold.append(name)
+    db.rollback()
+
+    # VACUUM refuses to run inside a transaction block
+    db.autocommit = True
+    try:
+        for name in cold:
+            cur.execute(f"VACUUM (FREEZE, ANALYZE) {name}")
+            cur.execute(f"ALTER TABLE {name} SET (autovacuum_enabled = false)")
+            if MESSAGE_ARCHIVE_TABLESPACE:
+                cur.execute(f'ALTER TABLE {name} SET TABLESPACE "{MESSAGE_ARCHIVE_TABLESPACE}"')
+                cur.execute("SELECT indexname FROM pg_indexes WHERE tablename = %s", (name,))
+                for (index,) in cur.fetchall():
+                    cur.execute(f'ALTER INDEX {index} SET TABLESPACE "{MESSAGE_ARCHIVE_TABLESPACE}"')
+    finally:
+        db.autocommit = False
+    return cold
+
+@app.cli.command("message-partitions")
+def message_partitions_command():
+    """Create the next messages partition ahead of time."""
+    db = get_db()
+    cur = db.cursor()
+    cur.execute("SELECT COALESCE(MAX(id), 0) FROM messages")
+    ensure_message_partitions(cur, cur.fetchone()[0])
+    db.commit()
+    for n, name, archived in message_partitions(cur):
+        print(f"{name}  ids {n * MESSAGE_PARTITION_SIZE}..{(n + 1) * MESSAGE_PARTITION_SIZE - 1}"
+              f"{'  archived' if archived else ''}")
+
+@app.cli.command("archive-messages")
+def archive_messages_command():
+    """Freeze (and optionally move) messages partitions past MESSAGE_ARCHIVE_DAYS."""
+    cold = archive_message_partitions()
+    print(f"archived {len(cold)} partitions" + (f": {', '.join(cold)}" if cold else ""))
 
 @app.route("/chat")
 @app.route("/chat/<username>") 
@@ -110,31 +768,130 @@ def chat_page(username=None):
                            current_username=session.get("username"),
                            target_username=username)
 
+register_statement("dm_list_version", """
+    SELECT COUNT(*), MAX(c.last_message_id), SUM(c.unread_count), MAX(u.revision)
+    FROM conversations c
+    JOIN users u ON u.id = c.partner_id
+    WHERE c.user_id = %(user)s AND c.partner_id != %(user)s
+""", {"user": 1}, user="integer")
+
+register_statement("dm_list", """
+    SELECT u.id, u.username, c.last_preview, c.last_at, c.unread_count
+    FROM conversations c
+    JOIN users u ON u.id = c.partner_id
+    WHERE c.user_id = %(user)s AND c.partner_id != %(user)s
+    ORDER BY c.last_at DESC
+""", {"user": 1}, user="integer")
+
 @app.route("/api/dm_list")
 def get_dm_list():
     if "user_id" not in session:
         return {"error": "unauthorized"}, 401
     
-    db = get_db()
+    db = get_read_db()
     cur = db.cursor()
+
+    # New messages raise the max id, reads lower the unread sum and a partner
+    # renaming or leaving bumps their revision
+    execute_prepared(cur, "dm_list_version", {"user": session["user_id"]})
+    etag = make_etag("dm_list", session["user_id"], *cur.fetchone())
+    cached = not_modified(etag)
+    if cached:
+        return cached
     
-    cur.execute("""
-        SELECT u.id, u.username, 
-               (SELECT content FROM messages 
-                WHERE (sender_id = u.id AND receiver_id = %s) 
-                   OR (sender_id = %s AND receiver_id = u.id)
-                ORDER BY id DESC LIMIT 1) as last_msg
-        FROM users u
-        WHERE u.id IN (
-            SELECT DISTINCT sender_id FROM messages WHERE receiver_id = %s
-            UNION
-            SELECT DISTINCT receiver_id FROM messages WHERE sender_id = %s
-        ) AND u.id != %s
-    """, (session["user_id"], session["user_id"], session["user_id"], session["user_id"], session["user_id"]))
+    execute_prepared(cur, "dm_list", {"user": session["user_id"]})
     
-    users = [{"id": row[0], "username": row[1], "last_msg": row[2]} for row in cur.fetchall()]
-    db.close()
-    return {"users": users}
+    users = [
+        {
+            "id": row[0],
+            "username": row[1],
+            "last_msg": row[2],
+            "last_at": row[3].isoformat() if hasattr(row[3], "isoformat") else row[3],
+            "unread": row[4]
+        }
+        for row in cur.fetchall()
+    ]
+    return tagged(jsonify({"users": users}), etag)
+
+SEARCH_LIMIT = 10
+SEARCH_CACHE_TTL = int(os.getenv("SEARCH_CACHE_TTL", "30"))
+SEARCH_CACHE_SIZE = 1024
+
+# lowered query -> (expires_at, rows, complete). Rows are shared by every
+# viewer, so one extra row is kept to make room for dropping the viewer.
+_search_cache = OrderedDict()
+_search_lock = threading.Lock()
+
+def search_rank(q):
+    # Exact match, then prefix matches, then shortest names first
+    def key(row):
+        name = row[1].lower()
+        return (name != q, not name.startswith(q), len(name), name)
+    return key
+
+def cached_search(q):
+    now = time.monotonic()
+    with _search_lock:
+        for n in range(len(q), 0, -1):
+            hit = _search_cache.get(q[:n])
+            if not hit or hit[0] <= now:
+                continue
+            expires, rows, complete = hit
+            if n == len(q):
+                _search_cache.move_to_end(q)
+                return rows
+            # A complete answer for a shorter prefix already holds every
+            # match for the longer query as-you-type produces next
+            if complete:
+                return sorted(
+                    [r for r in rows if q in r[1].lower()],
+                    key=search_rank(q)
+                )[:SEARCH_LIMIT + 1]
+    return None
+
+register_statement("user_search", """
+    SELECT id, username FROM users
+    WHERE lower(username) LIKE %(pattern)s AND is_deleted = 0
+    ORDER BY
+        lower(username) = %(q)s DESC,
+        lower(username) LIKE %(prefix)s DESC,
+        length(username),
+        lower(username)
+    LIMIT %(limit)s
+""", {"pattern": "%bob%", "q": "bob", "prefix": "bob%", "limit": SEARCH_LIMIT + 1},
+    pattern="text", q="text", prefix="text", limit="integer")
+
+def find_users(q):
+    rows = cached_search(q)
+    if rows is not None:
+        return rows
+
+    # Backed by the pg_trgm GIN index on lower(username)
+    pattern = "%" + q.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+    db = get_read_db()
+    cur = db.cursor()
+    execute_prepared(cur, "user_search", {
+        "pattern": pattern,
+        "q": q,
+        "prefix": pattern[1:],
+        "limit": SEARCH_LIMIT + 1
+    })
+    rows = cur.fetchall()
+
+    with _search_lock:
+        _search_cache[q] = (
+            time.monotonic() + SEARCH_CACHE_TTL,
+            rows,
+            len(rows) <= SEARCH_LIMIT
+        )
+        _search_cache.move_to_end(q)
+        while len(_search_cache) > SEARCH_CACHE_SIZE:
+            _search_cache.popitem(last=False)
+    return rows
+
+def clear_search_cache():
+    with _search_lock:
+        _search_cache.clear()
 
 @app.route("/api/search_users")
 def search_users():
@@ -145,61 +902,260 @@ def search_users():
     if not query:
         return {"users": []}
 
-    db = get_db()
-    cur = db.cursor()
-    cur.execute(
-        "SELECT id, username FROM users WHERE username ILIKE %s AND is_deleted = 0 AND id != %s LIMIT 10",
-        (f"%{query}%", session["user_id"])
-    )
-    users = [{"id": row[0], "username": row[1]} for row in cur.fetchall()]
-    db.close()
+    rows = find_users(query.lower())
+    users = [
+        {"id": row[0], "username": row[1]}
+        for row in rows if row[0] != session["user_id"]
+    ][:SEARCH_LIMIT]
     return {"users": users}
 
+MESSAGE_PAGE_SIZE = 50
+MESSAGE_PAGE_MAX = 200
+
+# messages.created_at comes from migration 1; older databases need the
+# column added before this page can load
+MESSAGES_PAGE = """
+    SELECT id, sender_id, content, created_at
+    FROM messages
+    WHERE ((sender_id = %(user)s AND receiver_id = %(other)s)
+        OR (sender_id = %(other)s AND receiver_id = %(user)s))
+    {keyset}
+    ORDER BY id {order}
+    LIMIT %(limit)s
+"""
+for name, keyset, order in (
+    ("messages_latest", "", "DESC"),
+    ("messages_after", "AND id > %(cursor)s", "ASC"),
+    ("messages_before", "AND id < %(cursor)s", "DESC")
+):
+    register_statement(
+        name, MESSAGES_PAGE.format(keyset=keyset, order=order),
+        {"user": 1, "other": 2, "cursor": 0, "limit": MESSAGE_PAGE_SIZE + 1},
+        user="integer", other="integer", cursor="integer", limit="integer"
+    )
+
+register_statement("conversation_head", """
+    SELECT last_message_id, unread_count FROM conversations
+    WHERE user_id = %(user)s AND partner_id = %(partner)s
+""", {"user": 1, "partner": 2}, user="integer", partner="integer")
+
+register_statement("conversation_read", """
+    UPDATE conversations SET unread_count = 0
+    WHERE user_id = %(user)s AND partner_id = %(partner)s AND unread_count > 0
+""", {"user": 1, "partner": 2}, user="integer", partner="integer")
+
 @app.route("/api/get_messages/<int:other_id>")
 def get_messages(other_id):
     if "user_id" not in session:
         return {"error": "unauthorized"}, 401
     
     user_id = session["user_id"]
+
+    # after_id: newer messages for polling, before_id: older history on
+    # scroll-up, neither: the latest page
+    # Parsed by hand: type=int would turn a bad cursor into None and
+    # quietly serve the latest page instead
+    try:
+        after_id = request.args.get("after_id")
+        before_id = request.args.get("before_id")
+        after_id = None if after_id is None else int(after_id)
+        before_id = None if before_id is None else int(before_id)
+        limit = int(request.args.get("limit", MESSAGE_PAGE_SIZE))
+    except ValueError:
+        return {"error": "invalid cursor"}, 400
+    if any(c is not None and not 0 <= c <= MAX_ID for c in (after_id, before_id)):
+        return {"error": "invalid cursor"}, 400
+    limit = max(1, min(limit, MESSAGE_PAGE_MAX))
+
+    if after_id is not None:
+        statement, order = "messages_after", "ASC"
+    elif before_id is not None:
+        statement, order = "messages_before", "DESC"
+    else:
+        statement, order = "messages_latest", "DESC"
+
     db = get_db()
     cur = db.cursor()
+
+    # Messages are never edited, so the newest id in the conversation versions
+    # every page of it. Self-chats have no summary row and skip this.
+    etag = None
+    if other_id != user_id:
+        execute_prepared(cur, "conversation_head", {"user": user_id, "partner": other_id})
+        row = cur.fetchone()
+        last_message_id, unread = row if row else (None, 0)
+        etag = make_etag("messages", user_id, other_id, last_message_id, after_id, before_id, limit)
+        # Unread messages still have to be marked read below
+        if not unread or before_id is not None:
+            cached = not_modified(etag)
+            if cached:
+                return cached
     
-    cur.execute("""
-        SELECT sender_id, content, id 
-        FROM messages 
-        WHERE (sender_id = %s AND receiver_id = %s) 
-           OR (sender_id = %s AND receiver_id = %s)
-        ORDER BY id ASC
-    """, (user_id, other_id, other_id, user_id))
+    execute_prepared(cur, statement, {
+        "user": user_id,
+        "other": other_id,
+        "cursor": after_id if after_id is not None else before_id,
+        "limit": limit + 1
+    })
     
     rows = cur.fetchall()
-    db.close()
+
+    if before_id is None:
+        # The viewer is looking at the newest messages, so they're read now
+        execute_prepared(cur, "conversation_read", {"user": user_id, "partner": other_id})
+        db.commit()
+        # The DM list should show these as read straight away
+        g.wrote = cur.rowcount > 0
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if order == "DESC":
+        rows.reverse()
     
-    messages = [{"sender_id": r[0], "content": r[1]} for r in rows]
-    return jsonify({"messages": messages})
+    messages = [
+        {
+            "id": r[0],
+            "sender_id": r[1],
+            "content": r[2],
+            "created_at": r[3].isoformat() if hasattr(r[3], "isoformat") else r[3]
+        }
+        for r in rows
+    ]
+    response = jsonify({"messages": messages, "has_more": has_more})
+    return tagged(response, etag) if etag else response
 
 @app.route("/api/user_by_name/<username>")
 def user_by_name(username):
-    db = get_db()
-    cur = db.cursor()
-    cur.execute("SELECT id, username FROM users WHERE username = %s", (username,))
-    row = cur.fetchone()
-    db.close()
-    if row:
-        return {"id": row[0], "username": row[1]}
+    user = get_user_by_name(username)
+    if user:
+        return {"id": user["id"], "username": user["username"]}
     return {"error": "not found"}, 404
 
 @app.route("/api/user_by_id/<int:user_id>")
 def user_by_id(user_id):
-    db = get_db()
-    cur = db.cursor()
-    cur.execute("SELECT id, username FROM users WHERE id = %s", (user_id,))
-    row = cur.fetchone()
-    db.close()
-    if row:
-        return {"id": row[0], "username": row[1]}
+    user = get_user(user_id)
+    if user:
+        return {"id": user["id"], "username": user["username"]}
     return {"error": "not found"}, 404
 
+# --- MESSAGE FAN-OUT ---
+# send_message() NOTIFYs on this channel; one listener thread per process
+# hands each message to the in-memory queues of the receiver's open streams.
+#
+# Streams only ever wait on their queue, so under serve.py (gevent) each one
+# is a parked greenlet rather than a pinned worker thread. SSE_MAX_STREAMS
+# caps them per process either way so chat tabs can't starve /feed.
+MESSAGE_CHANNEL = "new_message"
+SSE_HEARTBEAT = int(os.getenv("SSE_HEARTBEAT", "15"))
+SSE_IDLE_TIMEOUT = int(os.getenv("SSE_IDLE_TIMEOUT", "600"))
+SSE_MAX_STREAMS = int(os.getenv("SSE_MAX_STREAMS", "100"))
+SSE_RETRY_MS = 5000
+# Most messages one catch-up announces; a stream resuming from a stale or
+# forged Last-Event-ID gets the newest ones rather than the whole inbox
+SSE_CATCH_UP_MAX = 20
+
+_subscribers = {}  # user_id -> set of queue.Queue
+_subscribers_lock = threading.Lock()
+_listener = {"thread": None}
+_streams = {"active": 0}
+
+def claim_stream_slot():
+    with _subscribers_lock:
+        if _streams["active"] >= SSE_MAX_STREAMS:
+            return False
+        _streams["active"] += 1
+        return True
+
+def release_stream_slot():
+    with _subscribers_lock:
+        _streams["active"] -= 1
+
+def subscribe_messages(user_id):
+    q = queue.Queue()
+    with _subscribers_lock:
+        _subscribers.setdefault(user_id, set()).add(q)
+        if _listener["thread"] is None or not _listener["thread"].is_alive():
+            _listener["thread"] = threading.Thread(target=message_listener, daemon=True)
+            _listener["thread"].start()
+    return q
+
+def unsubscribe_messages(user_id, q):
+    with _subscribers_lock:
+        queues = _subscribers.get(user_id)
+        if queues:
+            queues.discard(q)
+            if not queues:
+                del _subscribers[user_id]
+
+def dispatch_message(user_id, msg):
+    with _subscribers_lock:
+        queues = list(_subscribers.get(user_id, ()))
+    for q in queues:
+        q.put(msg)
+
+def resync_subscribers():
+    # None tells a stream to catch up from the database: notifications sent
+    # while the listener was (re)connecting are gone for good
+    with _subscribers_lock:
+        queues = [q for qs in _subscribers.values() for q in qs]
+    for q in queues:
+        q.put(None)
+
+def message_listener():
+    while True:
+        conn = None
+        try:
+            # A dedicated connection: LISTEN must outlive any single request
+            conn = psycopg2.connect(DATABASE_URL)
+            conn.autocommit = True
+            conn.cursor().execute(f"LISTEN {MESSAGE_CHANNEL}")
+            resync_subscribers()
+
+            while True:
+                if select.select([conn], [], [], 60) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    note = conn.notifies.pop(0)
+                    try:
+                        msg = json.loads(note.payload)
+                        dispatch_message(msg["receiver_id"], msg)
+                    except (ValueError, KeyError):
+                        continue
+        except (psycopg2.Error, OSError):
+            app.logger.exception("message listener lost its connection, reconnecting")
+        finally:
+            if conn is not None:
+                conn.close()
+        time.sleep(1)
+
+register_statement("stream_start", """
+    SELECT MAX(id) FROM messages WHERE receiver_id = %(user)s
+""", {"user": 1}, user="integer")
+
+register_statement("stream_catch_up", """
+    SELECT m.id, u.username
+    FROM messages m
+    JOIN users u ON m.sender_id = u.id
+    WHERE m.receiver_id = %(user)s AND m.id > %(last)s
+    ORDER BY m.id DESC
+    LIMIT %(limit)s
+""", {"user": 1, "last": 0, "limit": SSE_CATCH_UP_MAX},
+    user="integer", last="integer", limit="integer")
+
+def fetch_new_messages(user_id, last_id):
+    # The request connection is gone once streaming starts, so borrow
+    # one from the pool just for this query and hand it straight back
+    with pooled_db() as db:
+        cur = db.cursor()
+        execute_prepared(cur, "stream_catch_up", {
+            "user": user_id,
+            "last": last_id,
+            "limit": SSE_CATCH_UP_MAX
+        })
+        # Newest first from the query, oldest first on the wire
+        return cur.fetchall()[::-1]
+
 @app.route("/api/stream_messages")
 def stream_messages():
     if "user_id" not in session:
@@ -207,53 +1163,88 @@ def stream_messages():
     
     user_id = session["user_id"]
 
-    def event_stream():
-        last_id = 0
-        db = get_db()
-        cur = db.cursor()
-        cur.execute("SELECT MAX(id) FROM messages WHERE receiver_id = %s", (user_id,))
-        row = cur.fetchone()
-        if row and row[0]:
-            last_id = row[0]
-        db.close()
-
-        while True:
-            time.sleep(2) 
-            # Very important to close connection in the loop to avoid hitting limits
+    # The browser sends back the last id it saw when it reconnects (after
+    # the idle timeout or a dropped connection), so nothing that arrived in
+    # between is skipped
+    try:
+        resume_id = int(request.headers.get("Last-Event-ID", ""))
+    except ValueError:
+        resume_id = None
+    if resume_id is not None and not 0 <= resume_id <= MAX_ID:
+        resume_id = None
+
+    if not claim_stream_slot():
+        return {"error": "too many streams"}, 503, {"Retry-After": "30"}
+
+    if resume_id is not None:
+        start_id = resume_id
+    else:
+        try:
             db = get_db()
-            try:
-                cur = db.cursor()
-                cur.execute("""
-                    SELECT m.id, m.content, u.username 
-                    FROM messages m 
-                    JOIN users u ON m.sender_id = u.id 
-                    WHERE m.receiver_id = %s AND m.id > %s 
-                    ORDER BY m.id ASC
-                """, (user_id, last_id))
-                
-                new_messages = cur.fetchall()
-                for msg_id, content, sender in new_messages:
-                    last_id = msg_id
-                    yield f"data: {json.dumps({'sender': sender})}\n\n"
-            finally:
-                db.close()
+            cur = db.cursor()
+            execute_prepared(cur, "stream_start", {"user": user_id})
+            row = cur.fetchone()
+        except Exception:
+            release_stream_slot()
+            raise
+        start_id = row[0] if row and row[0] else 0
 
-    return Response(event_stream(), mimetype="text/event-stream")
+    def event_stream():
+        last_id = start_id
+        q = subscribe_messages(user_id)
+        # Covers anything sent between start_id and subscribing
+        q.put(None)
+        last_activity = time.monotonic()
+
+        try:
+            # Flushes headers so the browser sees the stream open right away,
+            # and gives it a position to resume from even if no message comes
+            yield f"retry: {SSE_RETRY_MS}\nid: {start_id}\n: connected\n\n"
+
+            while True:
+                try:
+                    msg = q.get(timeout=SSE_HEARTBEAT)
+                except queue.Empty:
+                    # Idle streams end and the browser reconnects after
+                    # SSE_RETRY_MS, which clears out abandoned tabs
+                    if time.monotonic() - last_activity >= SSE_IDLE_TIMEOUT:
+                        return
+                    yield f"data: {json.dumps({'status': 'heartbeat'})}\n\n"
+                    continue
+
+                if msg is None:
+                    new_messages = fetch_new_messages(user_id, last_id)
+                else:
+                    new_messages = [(msg["id"], msg["sender"])]
+
+                for msg_id, sender in new_messages:
+                    if msg_id <= last_id:
+                        continue
+                    last_id = msg_id
+                    last_activity = time.monotonic()
+                    yield f"id: {msg_id}\ndata: {json.dumps({'sender': sender})}\n\n"
+        finally:
+            unsubscribe_messages(user_id, q)
+
+    response = Response(event_stream(), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"
+    # Runs even if the client leaves before the generator ever starts
+    response.call_on_close(release_stream_slot)
+    return response
 
 @app.route("/post", methods=["POST"])
 def create_post():
     if "user_id" not in session:
         return {"error": "unauthorized"}, 401
     
+    user = get_user(session["user_id"])
+    if user and user["is_muted"]:
+        return {"error": "muted"}, 403
+
     db = get_db()
     cur = db.cursor()
     
-    cur.execute("SELECT is_muted FROM users WHERE id=%s", (session["user_id"],))
-    row = cur.fetchone()
-    if row and row[0]:
-        db.close()
-        return {"error": "muted"}, 403
-    
     post_type = request.form.get("type", "text")
     
     if post_type == "poll":
@@ -267,12 +1258,16 @@ def create_post():
         if len(options) < 2 or len(options) > 5:
             return {"error": "Poll must have 2–5 options"}, 400
        
-        # 1️⃣ create post (RETURNING id for PostgreSQL)
+        # 1️⃣ create post; the count subquery sees the table before the insert
         cur.execute(
-            "INSERT INTO posts (user_id, content, created_at, is_public, type) VALUES (%s, '', %s, 1, 'poll') RETURNING id",
-            (session["user_id"], datetime.now(timezone.utc))
+            """
+            INSERT INTO posts (user_id, content, created_at, is_public, type)
+            VALUES (%s, '', %s, 1, 'poll')
+            RETURNING id, (SELECT COUNT(*) FROM posts WHERE user_id = %s) + 1
+            """,
+            (session["user_id"], datetime.now(timezone.utc), session["user_id"])
         )
-        post_id = cur.fetchone()[0]
+        post_id, post_count = cur.fetchone()
        
         # 2️⃣ create poll
         cur.execute(
@@ -288,181 +1283,212 @@ def create_post():
             )
        
         db.commit()
-        db.close()
+        clear_feed_cache()
         return {
             "success": True,
-            "post_count": get_post_count(session["user_id"])
+            "post_count": post_count
         }
 
     # TEXT POST
     content = request.form["content"]
+    check_censor(cur)
+    rendered = render_post(content)
 
     cur.execute(
-        "INSERT INTO posts (user_id, content, created_at, is_public, type) VALUES (%s, %s, %s, 1, 'text') RETURNING id",
-        (session["user_id"], content, datetime.now(timezone.utc))
+        """
+        INSERT INTO posts (user_id, content, rendered_html, render_version, created_at, is_public, type)
+        VALUES (%s, %s, %s, %s, %s, 1, 'text')
+        RETURNING id, created_at, (SELECT COUNT(*) FROM posts WHERE user_id = %s) + 1
+        """,
+        (session["user_id"], content, rendered, RENDER_VERSION, datetime.now(timezone.utc), session["user_id"])
     )
-    post_id = cur.fetchone()[0]
+    post_id, created_at, post_count = cur.fetchone()
     db.commit()
-
-    cur.execute("""
-        SELECT posts.id, users.username, posts.created_at
-        FROM posts
-        JOIN users ON posts.user_id = users.id
-        WHERE posts.id = %s
-    """, (post_id,))
-    row = cur.fetchone()
-    db.close()
-
-    IST = timezone(timedelta(hours=5, minutes=30))
-    # Ensure datetime format matches what's returned from PostgreSQL
-    dt_obj = datetime.fromisoformat(str(row[2])) if isinstance(row[2], str) else row[2]
-    pretty_time = dt_obj.astimezone(IST).strftime("%d/%m/%Y - %I:%M %p").lower()
+    clear_feed_cache()
 
     return {
         "id": post_id,
         "type": "text",
-        "username": row[1],
-        "content": render_post(content),
-        "time": pretty_time,
+        "username": user["username"] if user else session.get("username"),
+        "content": rendered,
+        "time": format_post_time(created_at),
         "like_count": 0,
         "is_admin": is_admin_user(session["user_id"]),
-        "post_count": get_post_count(session["user_id"])
+        "post_count": post_count
     }
 
-def censor_text(text):
-    db = get_db()
-    cur = db.cursor()
-    cur.execute("SELECT word FROM curse_words")
-    words = [w[0] for w in cur.fetchall()]
-    db.close()
-
-    for w in words:
-        def repl(m):
-            first = m.group(0)[0]
-            return first + "*" * (len(m.group(0)) - 1)
+CENSOR_CACHE_TTL = int(os.getenv("CENSOR_CACHE_TTL", "300"))
 
-        text = re.sub(rf'\b{re.escape(w)}\b', repl, text, flags=re.IGNORECASE)
+# The whole curse word list compiled into one alternation, so censoring is a
+# single pass over the text however many words are banned. /admin/curse
+# rebuilds it straight away; the TTL lets other workers pick new words up.
+_censor = {"pattern": None, "words": 0, "expires": 0}
 
-    return text
-
-@app.route("/vote/<int:option_id>", methods=["POST"])
-def vote(option_id):
-    if "user_id" not in session:
-        return {"error": "unauthorized"}, 401
-
-    user_id = session["user_id"]
+def refresh_censor():
     db = get_db()
     cur = db.cursor()
-
-    # find poll
-    cur.execute("SELECT post_id FROM poll_options WHERE id=%s", (option_id,))
-    row = cur.fetchone()
-    if not row:
-        db.close()
-        return {"error": "invalid option"}, 400
-
-    post_id = row[0]
-
-    # did user already vote THIS option?
-    cur.execute(
-        "SELECT 1 FROM poll_votes WHERE user_id=%s AND option_id=%s",
-        (user_id, option_id)
-    )
-    already_voted = cur.fetchone()
-
-    if already_voted:
-        # 🔁 toggle OFF
-        cur.execute(
-            "DELETE FROM poll_votes WHERE user_id=%s AND option_id=%s",
-            (user_id, option_id)
+    cur.execute("SELECT word FROM curse_words")
+    rows = cur.fetchall()
+    words = [w[0] for w in rows if w[0]]
+
+    pattern = None
+    if words:
+        # Longest first so a word never loses to one of its own prefixes
+        words.sort(key=len, reverse=True)
+        pattern = re.compile(
+            r'\b(?:' + "|".join(re.escape(w) for w in words) + r')\b',
+            re.IGNORECASE
         )
-        action = "removed"
-    else:
-        # ❌ remove previous vote in THIS poll
-        cur.execute("""
-            DELETE FROM poll_votes
-            WHERE user_id=%s
-            AND option_id IN (
-                SELECT id FROM poll_options WHERE post_id=%s
-            )
-        """, (user_id, post_id))
 
-        # ✅ add new vote
-        cur.execute(
-            "INSERT INTO poll_votes (user_id, option_id) VALUES (%s, %s)",
-            (user_id, option_id)
-        )
-        action = "voted"
+    _censor["pattern"] = pattern
+    _censor["words"] = len(rows)
+    _censor["expires"] = time.monotonic() + CENSOR_CACHE_TTL
+    return pattern
+
+def get_censor_pattern():
+    if _censor["expires"] <= time.monotonic():
+        return refresh_censor()
+    return _censor["pattern"]
+
+def check_censor(cur):
+    # HTML stored under RENDER_VERSION is never redone, so a pattern that
+    # missed a word another worker just added must not render it. Words are
+    # only ever added, so the count tells whether ours is behind.
+    cur.execute("SELECT COUNT(*) FROM curse_words")
+    words = cur.fetchone()[0]
+    get_censor_pattern()
+    if words != _censor["words"]:
+        refresh_censor()
+
+def censor_word(m):
+    first = m.group(0)[0]
+    return first + "*" * (len(m.group(0)) - 1)
 
-    # 🔄 re-fetch updated results
-    cur.execute("""
-        SELECT
-            po.id,
-            COUNT(pv.user_id) AS votes,
-            MAX(CASE WHEN pv.user_id = %s THEN 1 ELSE 0 END) AS voted_by_me
-        FROM poll_options po
-        LEFT JOIN poll_votes pv ON pv.option_id = po.id
-        WHERE po.post_id=%s
-        GROUP BY po.id
-    """, (user_id, post_id))
+def censor_text(text):
+    pattern = get_censor_pattern()
+    if pattern is None:
+        return text
+    return pattern.sub(censor_word, text)
+
+# The write paths below take a cursor and return (body, status) without
+# committing, so /api/batch can run many of them in one transaction.
+register_statement("vote_toggle", """
+    WITH target AS (
+        SELECT id, post_id FROM poll_options WHERE id = %(option)s
+    ), removed AS (
+        DELETE FROM poll_votes pv
+        USING poll_options po, target t
+        WHERE pv.user_id = %(user)s AND pv.option_id = po.id AND po.post_id = t.post_id
+        RETURNING pv.option_id
+    ), added AS (
+        INSERT INTO poll_votes (user_id, option_id)
+        SELECT %(user)s, id FROM target
+        WHERE id NOT IN (SELECT option_id FROM removed)
+        ON CONFLICT DO NOTHING
+        RETURNING option_id
+    ), counted AS (
+        UPDATE poll_options po
+        SET vote_count = po.vote_count
+            + (SELECT COUNT(*) FROM added a WHERE a.option_id = po.id)
+            - (SELECT COUNT(*) FROM removed r WHERE r.option_id = po.id)
+        WHERE po.id IN (SELECT option_id FROM added UNION SELECT option_id FROM removed)
+        RETURNING po.id, po.vote_count
+    )
+    SELECT
+        po.id,
+        COALESCE(c.vote_count, po.vote_count),
+        %(option)s NOT IN (SELECT option_id FROM removed)
+    FROM poll_options po
+    LEFT JOIN counted c ON c.id = po.id
+    WHERE po.post_id = (SELECT post_id FROM target)
+    ORDER BY po.id
+""", {"option": 1, "user": 1}, option="integer", user="integer")
+
+def toggle_vote(cur, user_id, option_id):
+    # One statement: drop the user's vote(s) in this poll, add the new one
+    # unless it was just toggled off, move the counters and return the whole
+    # poll. Every CTE sees the same snapshot, so unchanged options are read
+    # from poll_options and changed ones from `counted`.
+    execute_prepared(cur, "vote_toggle", {"option": option_id, "user": user_id})
+    rows = cur.fetchall()
+    if not rows:
+        return {"error": "invalid option"}, 400
 
+    # A concurrent double-click finds the vote already there, which still
+    # leaves it voted
+    action = "voted" if rows[0][2] else "removed"
     options = [
         {
             "id": o[0],
             "votes": o[1],
-            "voted_by_me": bool(o[2])
+            "voted_by_me": action == "voted" and o[0] == option_id
         }
-        for o in cur.fetchall()
+        for o in rows
     ]
 
-    db.commit()
-    db.close()
-
     return {
         "action": action,
         "options": options
-    }
+    }, 200
 
-@app.route("/like/<int:post_id>", methods=["POST"])
-def like(post_id):
+@app.route("/vote/<int:option_id>", methods=["POST"])
+def vote(option_id):
     if "user_id" not in session:
         return {"error": "unauthorized"}, 401
 
     db = get_db()
-    cur = db.cursor()
-
-    cur.execute(
-        "SELECT 1 FROM likes WHERE user_id=%s AND post_id=%s",
-        (session["user_id"], post_id)
+    result = toggle_vote(db.cursor(), session["user_id"], option_id)
+    db.commit()
+    return result
+
+register_statement("like_toggle", """
+    WITH removed AS (
+        DELETE FROM likes WHERE user_id = %(user)s AND post_id = %(post)s
+        RETURNING 1
+    ), added AS (
+        INSERT INTO likes (user_id, post_id)
+        SELECT %(user)s, id FROM posts
+        WHERE id = %(post)s AND NOT EXISTS (SELECT 1 FROM removed)
+        ON CONFLICT DO NOTHING
+        RETURNING 1
     )
-    liked = cur.fetchone()
+    UPDATE posts
+    SET like_count = like_count + (SELECT COUNT(*) FROM added) - (SELECT COUNT(*) FROM removed)
+    WHERE id = %(post)s
+    RETURNING like_count, NOT EXISTS (SELECT 1 FROM removed)
+""", {"user": 1, "post": 1}, user="integer", post="integer")
+
+def toggle_like(cur, user_id, post_id):
+    # Toggle and counter in one statement. A concurrent double-click that
+    # loses the insert race adds nothing and reports the like it found.
+    execute_prepared(cur, "like_toggle", {"user": user_id, "post": post_id})
+    row = cur.fetchone()
+    if not row:
+        return {"error": "not found"}, 404
 
-    if liked:
-        cur.execute(
-            "DELETE FROM likes WHERE user_id=%s AND post_id=%s",
-            (session["user_id"], post_id)
-        )
-        action = "unliked"
-    else:
-        cur.execute(
-            "INSERT INTO likes (user_id, post_id) VALUES (%s, %s)",
-            (session["user_id"], post_id)
-        )
-        action = "liked"
+    return {
+        "action": "liked" if row[1] else "unliked",
+        "like_count": row[0]
+    }, 200
 
-    cur.execute(
-        "SELECT COUNT(*) FROM likes WHERE post_id=%s",
-        (post_id,)
-    )
-    like_count = cur.fetchone()[0]
+@app.route("/like/<int:post_id>", methods=["POST"])
+def like(post_id):
+    if "user_id" not in session:
+        return {"error": "unauthorized"}, 401
 
+    db = get_db()
+    result = toggle_like(db.cursor(), session["user_id"], post_id)
     db.commit()
-    db.close()
+    return result
 
-    return {
-        "action": action,
-        "like_count": like_count
-    }
+# Bump whenever render_post() output changes so stored HTML gets redone
+RENDER_VERSION = 1
+RERENDER_BATCH = 200
+
+# running: a pass is in progress; rerun: posts were marked stale since it
+# started, so it sweeps again from the first id when it reaches the end
+_rerender = {"running": False, "rerun": False}
+_rerender_lock = threading.Lock()
 
 def render_post(text):
     text = html.escape(text)
@@ -492,129 +1518,546 @@ def render_post(text):
     
     return text
 
-@app.route("/feed")
-def feed():
-    if "user_id" not in session:
-        return redirect("/")
+IST = timezone(timedelta(hours=5, minutes=30))
 
+def format_post_time(created_at):
+    # Ensure datetime format matches what's returned from PostgreSQL
+    dt_obj = datetime.fromisoformat(str(created_at)) if isinstance(created_at, str) else created_at
+    return dt_obj.astimezone(IST).strftime("%d/%m/%Y - %I:%M %p").lower()
+
+register_statement("poll_questions", """
+    SELECT post_id, question FROM polls WHERE post_id = ANY(%(posts)s)
+""", {"posts": [1, 2, 3]}, posts="integer[]")
+
+register_statement("poll_options", """
+    SELECT
+        po.post_id,
+        po.id,
+        po.option_text,
+        po.vote_count,
+        pv.user_id IS NOT NULL AS voted_by_me
+    FROM poll_options po
+    LEFT JOIN poll_votes pv ON pv.option_id = po.id AND pv.user_id = %(viewer)s
+    WHERE po.post_id = ANY(%(posts)s)
+    ORDER BY po.id
+""", {"viewer": 1, "posts": [1, 2, 3]}, viewer="integer", posts="integer[]")
+
+def load_polls(cur, post_ids, viewer_id=None):
+    # Two set-based queries for any number of polls instead of two per poll;
+    # vote totals come from the poll_options.vote_count counters
+    if not post_ids:
+        return {}
+
+    execute_prepared(cur, "poll_questions", {"posts": post_ids})
+    polls = {pid: {"question": q, "options": []} for pid, q in cur.fetchall()}
+
+    execute_prepared(cur, "poll_options", {"viewer": viewer_id, "posts": post_ids})
+
+    for post_id, option_id, text, votes, voted_by_me in cur.fetchall():
+        poll = polls.setdefault(post_id, {"question": "", "options": []})
+        poll["options"].append({
+            "id": option_id,
+            "text": text,
+            "votes": votes,
+            "voted_by_me": bool(voted_by_me)
+        })
+
+    for poll in polls.values():
+        set_poll_percents(poll["options"])
+
+    return polls
+
+def set_poll_percents(options):
+    total_votes = sum(o["votes"] for o in options)
+    for o in options:
+        percent = (o["votes"] / total_votes * 100) if total_votes else 0
+        o["percent"] = round(percent, 1)
+
+def hydrate_posts(cur, posts, viewer_id=None):
+    # Turns partially built post dicts (carrying raw "content", "created_at"
+    # and the stored "rendered_html"/"render_version") into what the feed,
+    # profile and admin panel hand to the client
+    polls = load_polls(
+        cur,
+        [p["id"] for p in posts if p["type"] == "poll"],
+        viewer_id
+    )
+
+    for post in posts:
+        post["time"] = format_post_time(post.pop("created_at"))
+        content = post.pop("content")
+        rendered = post.pop("rendered_html")
+        version = post.pop("render_version")
+
+        if post["type"] == "poll":
+            poll = polls.get(post["id"], {"question": "", "options": []})
+            post["question"] = poll["question"]
+            post["options"] = poll["options"]
+        elif rendered is not None and version == RENDER_VERSION:
+            post["content"] = rendered
+        else:
+            # Not re-rendered yet; the background pass will store it
+            post["content"] = render_post(content)
+
+    return posts
+
+def rerender_stale_posts():
+    # Re-renders text posts whose stored HTML is missing or from another
+    # renderer version, a batch per transaction. Returns how many were redone.
+    # A call while a pass runs leaves it to that pass, which may already be
+    # past the newly marked ids, so it asks for another sweep instead.
+    with _rerender_lock:
+        if _rerender["running"]:
+            _rerender["rerun"] = True
+            return 0
+        _rerender["running"] = True
+
+    done = 0
+    try:
+        db = get_db()
+        cur = db.cursor()
+        while True:
+            check_censor(cur)
+            last_id = 0
+            while True:
+                # Walks the primary key from where the last batch stopped
+                # rather than rescanning the rows already done
+                cur.execute("""
+                    SELECT id, content FROM posts
+                    WHERE id > %s AND type = 'text' AND render_version IS DISTINCT FROM %s
+                    ORDER BY id
+                    LIMIT %s
+                """, (last_id, RENDER_VERSION, RERENDER_BATCH))
+                rows = cur.fetchall()
+                if not rows:
+                    break
+                last_id = rows[-1][0]
+
+                for post_id, content in rows:
+                    cur.execute(
+                        "UPDATE posts SET rendered_html=%s, render_version=%s WHERE id=%s",
+                        (render_post(content or ""), RENDER_VERSION, post_id)
+                    )
+                db.commit()
+                done += len(rows)
+
+            # Checked and cleared under the lock, so a request arriving while
+            # this pass finishes is never dropped
+            with _rerender_lock:
+                if not _rerender["rerun"]:
+                    _rerender["running"] = False
+                    return done
+                _rerender["rerun"] = False
+    except BaseException:
+        with _rerender_lock:
+            _rerender["running"] = False
+        raise
+
+def rerender_in_background():
+    def run():
+        with app.app_context():
+            rerender_stale_posts()
+
+    threading.Thread(target=run, daemon=True).start()
+
+@app.cli.command("rerender-posts")
+def rerender_posts_command():
+    """Re-render stored post HTML after a renderer change."""
+    print(f"re-rendered {rerender_stale_posts()} posts")
+
+def recount_counters():
+    # Rebuilds posts.like_count and poll_options.vote_count from the source
+    # tables, touching only rows that drifted. Returns how many were fixed.
     db = get_db()
     cur = db.cursor()
 
-    cur.execute("SELECT COUNT(*) FROM posts WHERE user_id=%s", (session["user_id"],))
-    post_count = cur.fetchone()[0]
+    cur.execute("""
+        UPDATE posts p SET like_count = c.n
+        FROM (
+            SELECT posts.id, COUNT(likes.post_id) AS n
+            FROM posts
+            LEFT JOIN likes ON likes.post_id = posts.id
+            GROUP BY posts.id
+        ) c
+        WHERE p.id = c.id AND p.like_count IS DISTINCT FROM c.n
+    """)
+    fixed = cur.rowcount
 
     cur.execute("""
-        SELECT
-            posts.id,
-            posts.user_id,
-            posts.content,
-            posts.type,
-            CASE
-                WHEN users.is_deleted = 1
-                THEN 'Deleted User [' || users.id || ']'
-                ELSE users.username
-            END AS username,
-            users.is_deleted,
-            posts.created_at,
-            posts.is_public,
-            COUNT(likes.post_id),
-            MAX(CASE WHEN likes.user_id = %s THEN 1 ELSE 0 END) AS liked
-        FROM posts
-        LEFT JOIN users ON posts.user_id = users.id
-        LEFT JOIN likes ON posts.id = likes.post_id
-        WHERE posts.is_public = 1 OR posts.user_id = %s
-        GROUP BY 
-            posts.id, 
-            posts.user_id, 
-            posts.content, 
-            posts.type, 
-            users.is_deleted, 
-            users.id, 
-            users.username, 
-            posts.created_at, 
-            posts.is_public
-        ORDER BY posts.created_at DESC
-    """, (session["user_id"], session["user_id"]))
+        UPDATE poll_options po SET vote_count = c.n
+        FROM (
+            SELECT poll_options.id, COUNT(poll_votes.option_id) AS n
+            FROM poll_options
+            LEFT JOIN poll_votes ON poll_votes.option_id = poll_options.id
+            GROUP BY poll_options.id
+        ) c
+        WHERE po.id = c.id AND po.vote_count IS DISTINCT FROM c.n
+    """)
+    fixed += cur.rowcount
 
-    rows = cur.fetchall()
-    posts = []
+    db.commit()
+    return fixed
+
+@app.cli.command("recount")
+def recount_command():
+    """Repair like and vote counters from the likes/poll_votes tables."""
+    print(f"fixed {recount_counters()} counters")
+
+FEED_PAGE_SIZE = int(os.getenv("FEED_PAGE_SIZE", "20"))
+
+def encode_feed_cursor(created_at, post_id):
+    stamp = created_at if isinstance(created_at, str) else created_at.isoformat()
+    return f"{post_id}:{stamp}"
+
+def decode_feed_cursor(cursor):
+    # "<post id>:<created_at>" — the timestamp itself contains colons
+    try:
+        post_id, stamp = cursor.split(":", 1)
+        post_id = int(post_id)
+        if not 0 <= post_id <= MAX_ID:
+            return None
+        return datetime.fromisoformat(stamp), post_id
+    except (AttributeError, ValueError):
+        return None
+
+FEED_CACHE_TTL = float(os.getenv("FEED_CACHE_TTL", "10"))
+FEED_CACHE_PAGES = 64
+
+# cursor -> (expires_at, public posts). The public part of a feed page is the
+# same for everyone, so it is hydrated once with no viewer and shared; each
+# request then merges in the viewer's private posts, marks their likes and
+# votes and refreshes the like and vote counters. Writes that change which
+# posts are listed or how they render clear it after committing; the TTL
+# bounds what other workers' writes can leave stale.
+_feed_cache = OrderedDict()
+_feed_cache_lock = threading.Lock()
+_feed_cache_gen = 0
+
+def clear_feed_cache():
+    global _feed_cache_gen
+    with _feed_cache_lock:
+        _feed_cache.clear()
+        _feed_cache_gen += 1
+
+# Keyset pagination on (created_at, id) so each page is an index range scan
+# instead of sorting the whole posts table
+FEED_SELECT = """
+    SELECT
+        posts.id,
+        posts.user_id,
+        posts.content,
+        posts.rendered_html,
+        posts.render_version,
+        posts.type,
+        CASE
+            WHEN users.is_deleted = 1
+            THEN 'Deleted User [' || users.id || ']'
+            ELSE users.username
+        END AS username,
+        users.is_deleted,
+        posts.created_at,
+        posts.is_public,
+        posts.like_count,
+        COALESCE(users.username = %(admin)s, FALSE) AS is_admin
+    FROM posts
+    LEFT JOIN users ON posts.user_id = users.id
+    WHERE {where}
+    {keyset}
+    ORDER BY posts.created_at DESC, posts.id DESC
+    LIMIT %(limit)s
+"""
+for name, where in (
+    ("feed_public", "posts.is_public = 1"),
+    ("feed_private", "posts.is_public = 0 AND posts.user_id = %(viewer)s")
+):
+    for suffix, keyset in (("", ""), ("_after", "AND (posts.created_at, posts.id) < (%(at)s, %(at_id)s)")):
+        register_statement(
+            name + suffix, FEED_SELECT.format(where=where, keyset=keyset),
+            {"admin": ADMIN_USERNAME, "viewer": 1, "at": datetime.now(timezone.utc),
+             "at_id": MAX_ID, "limit": FEED_PAGE_SIZE + 1},
+            admin="text", viewer="integer", at="timestamptz", at_id="integer", limit="integer"
+        )
+
+def select_feed_posts(cur, viewer_id, after):
+    # viewer_id picks that user's private posts, None the public ones
+    name = "feed_public" if viewer_id is None else "feed_private"
+    execute_prepared(cur, name + ("_after" if after else ""), {
+        "admin": ADMIN_USERNAME,
+        "viewer": viewer_id,
+        "at": after[0] if after else None,
+        "at_id": after[1] if after else None,
+        "limit": FEED_PAGE_SIZE + 1
+    })
 
-    IST = timezone(timedelta(hours=5, minutes=30))
+    posts = []
 
-    for r in rows:
+    for r in cur.fetchall():
         (
-            post_id, user_id, content, ptype,
+            post_id, user_id, content,
+            rendered_html, render_version, ptype,
             username, is_deleted,
             created_at, is_public,
-            likes, liked
+            likes, author_is_admin
         ) = r
-        
-        dt_obj = datetime.fromisoformat(str(created_at)) if isinstance(created_at, str) else created_at
-        pretty_time = dt_obj.astimezone(IST).strftime("%d/%m/%Y - %I:%M %p").lower()
 
-        post = {
+        posts.append({
             "id": post_id,
             "user_id": user_id,
             "type": ptype,
             "username": username,
-            "time": pretty_time,
+            "content": content,
+            "rendered_html": rendered_html,
+            "render_version": render_version,
+            "created_at": created_at,
             "is_public": is_public,
             "like_count": likes,
-            "liked_by_me": bool(liked),
-            "is_admin": is_admin_user(user_id)
-        }
-        post["is_deleted_user"] = bool(is_deleted)
-        if ptype == "poll":
-            cur.execute("SELECT question FROM polls WHERE post_id=%s", (post_id,))
-            post["question"] = cur.fetchone()[0]
-        
-            cur.execute("""
-                SELECT
-                    po.id,
-                    po.option_text,
-                    COUNT(pv.user_id) AS votes,
-                    MAX(CASE WHEN pv.user_id = %s THEN 1 ELSE 0 END) AS voted_by_me
-                FROM poll_options po
-                LEFT JOIN poll_votes pv ON pv.option_id = po.id
-                WHERE po.post_id=%s
-                GROUP BY po.id, po.option_text
-            """, (session["user_id"], post_id))
-        
-            options = []
-            total_votes = 0
-        
-            rows2 = cur.fetchall()
-            for o in rows2:
-                total_votes += o[2]
-        
-            for o in rows2:
-                percent = (o[2] / total_votes * 100) if total_votes else 0
-                options.append({
-                    "id": o[0],
-                    "text": o[1],
-                    "votes": o[2],
-                    "percent": round(percent, 1),
-                    "voted_by_me": bool(o[3])
-                })
-        
-            post["options"] = options
-
+            "liked_by_me": False,
+            "is_admin": author_is_admin,
+            "is_deleted_user": bool(is_deleted)
+        })
+
+    # Keeps the raw timestamp for ordering and cursors; hydrate_posts pops
+    # created_at and formats it for display
+    for post in posts:
+        post["sort_key"] = (post["created_at"], post["id"])
+    return hydrate_posts(cur, posts)
+
+def public_feed_posts(cur, cursor, after, fresh=False):
+    # fresh skips the cached copy, which another viewer may have filled from
+    # a replica that hasn't seen this viewer's latest write; the result is
+    # still stored for everyone else
+    with _feed_cache_lock:
+        cached = None if fresh else _feed_cache.get(cursor)
+        if cached and cached[0] > time.monotonic():
+            _feed_cache.move_to_end(cursor)
+            return cached[1]
+        gen = _feed_cache_gen
+
+    posts = select_feed_posts(cur, None, after)
+
+    with _feed_cache_lock:
+        # Skip storing if a write cleared the cache while this was loading
+        if gen == _feed_cache_gen:
+            _feed_cache[cursor] = (time.monotonic() + FEED_CACHE_TTL, posts)
+            _feed_cache.move_to_end(cursor)
+            while len(_feed_cache) > FEED_CACHE_PAGES:
+                _feed_cache.popitem(last=False)
+    return posts
+
+register_statement("feed_overlay", """
+    SELECT 'like', post_id, NULL::integer FROM likes
+    WHERE user_id = %(viewer)s AND post_id = ANY(%(posts)s)
+    UNION ALL
+    SELECT 'vote', option_id, NULL FROM poll_votes
+    WHERE user_id = %(viewer)s AND option_id = ANY(%(options)s)
+    UNION ALL
+    SELECT 'likes', id, like_count FROM posts
+    WHERE id = ANY(%(posts)s)
+    UNION ALL
+    SELECT 'votes', id, vote_count FROM poll_options
+    WHERE id = ANY(%(options)s)
+""", {"viewer": 1, "posts": [1, 2, 3], "options": [1, 2, 3]},
+    viewer="integer", posts="integer[]", options="integer[]")
+
+def overlay_viewer(cur, posts, viewer_id):
+    # One primary-key lookup for the viewer's likes and votes on this page
+    # and the current counters. Counters come from here rather than the
+    # cached page, so likes and votes don't have to clear the cache.
+    execute_prepared(cur, "feed_overlay", {
+        "viewer": viewer_id,
+        "posts": [p["id"] for p in posts],
+        "options": [o["id"] for p in posts if p["type"] == "poll" for o in p["options"]]
+    })
+
+    marks = {"like": set(), "vote": set(), "likes": {}, "votes": {}}
+    for kind, target, count in cur.fetchall():
+        if count is None:
+            marks[kind].add(target)
         else:
-            post["content"] = render_post(content)
+            marks[kind][target] = count
+
+    for post in posts:
+        post["liked_by_me"] = post["id"] in marks["like"]
+        post["like_count"] = marks["likes"].get(post["id"], post["like_count"])
+        if post["type"] == "poll":
+            for o in post["options"]:
+                o["voted_by_me"] = o["id"] in marks["vote"]
+                o["votes"] = marks["votes"].get(o["id"], o["votes"])
+            set_poll_percents(post["options"])
+
+def load_feed_page(cur, viewer_id, cursor=None, fresh=False):
+    after = decode_feed_cursor(cursor) if cursor else None
+
+    # Copies, so the overlay never touches the shared cached dicts
+    public = [
+        dict(p, options=[dict(o) for o in p["options"]]) if p["type"] == "poll" else dict(p)
+        for p in public_feed_posts(cur, cursor, after, fresh)
+    ]
+    private = select_feed_posts(cur, viewer_id, after)
+
+    # Each list holds its own top FEED_PAGE_SIZE + 1, so the merged top
+    # FEED_PAGE_SIZE + 1 is exact
+    rows = sorted(public + private, key=lambda p: p["sort_key"], reverse=True)
+    next_cursor = None
+    if len(rows) > FEED_PAGE_SIZE:
+        rows = rows[:FEED_PAGE_SIZE]
+        next_cursor = encode_feed_cursor(*rows[-1]["sort_key"])
+
+    # Raw timestamp kept for /api/feed; the templates use the formatted "time"
+    for post in rows:
+        post["created_at"] = post.pop("sort_key")[0]
+
+    if rows:
+        overlay_viewer(cur, rows, viewer_id)
+
+    return rows, next_cursor
+
+# Template output is flushed every this many Jinja chunks rather than one
+# socket write per expression
+STREAM_BUFFER = int(os.getenv("STREAM_BUFFER", "20"))
+
+def stream_page(template_name, **context):
+    # stream_template with buffering: the browser gets the page head and CSS
+    # while the rest is still being rendered
+    app.update_template_context(context)
+    stream = app.jinja_env.get_template(template_name).stream(context)
+    stream.enable_buffering(STREAM_BUFFER)
+    g.streamed_stats = True
+    return Response(stream_with_context(stream), mimetype="text/html")
+
+class FeedPage:
+    # The first feed page as a lazy iterable: load_feed_page() runs when the
+    # streamed template reaches the posts loop, after the shell has gone out.
+    # The connection goes back to the pool as soon as the page is loaded, so
+    # a slow client downloading the posts doesn't hold one. next_cursor is
+    # set once iteration has started.
+    def __init__(self, viewer_id, fresh=False):
+        self.viewer_id = viewer_id
+        self.fresh = fresh
+        self.next_cursor = None
+
+    def __iter__(self):
+        try:
+            posts, self.next_cursor = load_feed_page(
+                get_read_db().cursor(), self.viewer_id, fresh=self.fresh
+            )
+        finally:
+            release_request_db()
+        return iter(posts)
 
-        posts.append(post)
+register_statement("post_count", """
+    SELECT COUNT(*) FROM posts WHERE user_id = %(user)s
+""", {"user": 1}, user="integer")
 
-    db.close()
+@app.route("/feed")
+def feed():
+    if "user_id" not in session:
+        return redirect("/")
+
+    db = get_read_db()
+    cur = db.cursor()
 
-    return render_template(
+    execute_prepared(cur, "post_count", {"user": session["user_id"]})
+    post_count = cur.fetchone()[0]
+    is_admin = is_admin_user(session["user_id"])
+
+    # Not needed again until the posts loop, which borrows its own
+    release_request_db()
+
+    return stream_page(
         "feed.html",
-        posts=posts,
+        posts=FeedPage(session["user_id"], fresh=feed_stale_for_viewer()),
         current_user=session["user_id"],
         current_username=session["username"],
         post_count=post_count,
-        is_admin=is_admin_user(session["user_id"])
+        is_admin=is_admin
+    )
+
+@app.route("/api/feed_page")
+def feed_page():
+    if "user_id" not in session:
+        return {"error": "unauthorized"}, 401
+
+    cursor = request.args.get("cursor")
+    if not cursor or not decode_feed_cursor(cursor):
+        return {"error": "invalid cursor"}, 400
+
+    db = get_read_db()
+    cur = db.cursor()
+    posts, next_cursor = load_feed_page(cur, session["user_id"], cursor, feed_stale_for_viewer())
+
+    return {
+        "html": render_template(
+            "feed_posts.html",
+            posts=posts,
+            current_user=session["user_id"],
+            is_admin=is_admin_user(session["user_id"])
+        ),
+        "next_cursor": next_cursor
+    }
+
+# /api/feed sends each post as an array in `fields` order instead of a dict,
+# so key names go over the wire once per page rather than once per post
+FEED_API_FIELDS = {
+    "id": lambda p: p["id"],
+    "user_id": lambda p: p["user_id"],
+    "username": lambda p: p["username"],
+    "type": lambda p: p["type"],
+    "content": lambda p: p.get("content"),
+    "like_count": lambda p: p["like_count"],
+    "liked": lambda p: p["liked_by_me"],
+    "is_public": lambda p: bool(p["is_public"]),
+    "is_admin": lambda p: p["is_admin"],
+    "deleted_user": lambda p: p["is_deleted_user"],
+    # [question, [[option id, text, votes, voted by me], ...]] or null
+    "poll": lambda p: [
+        p["question"],
+        [[o["id"], o["text"], o["votes"], o["voted_by_me"]] for o in p["options"]]
+    ] if p["type"] == "poll" else None
+}
+FEED_API_DEFAULT_FIELDS = [
+    "id", "user_id", "username", "type", "created", "content",
+    "like_count", "liked", "is_public", "is_admin", "poll"
+]
+
+def dump_json(data):
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, separators=(",", ":"), ensure_ascii=False).encode()
+
+@app.route("/api/feed")
+def feed_api():
+    # ?cursor= from the previous page, ?fields=id,created,... to pick columns,
+    # ?ts=iso for ISO 8601 "created" instead of epoch seconds
+    if "user_id" not in session:
+        return {"error": "unauthorized"}, 401
+
+    cursor = request.args.get("cursor") or None
+    if cursor and not decode_feed_cursor(cursor):
+        return {"error": "invalid cursor"}, 400
+
+    fields = request.args.get("fields")
+    fields = fields.split(",") if fields else FEED_API_DEFAULT_FIELDS
+    unknown = [f for f in fields if f != "created" and f not in FEED_API_FIELDS]
+    if unknown:
+        return {"error": f"unknown fields: {', '.join(unknown)}"}, 400
+
+    if request.args.get("ts") == "iso":
+        stamp = lambda p: p["created_at"].isoformat()
+    else:
+        stamp = lambda p: int(p["created_at"].timestamp())
+    getters = [stamp if f == "created" else FEED_API_FIELDS[f] for f in fields]
+
+    posts, next_cursor = load_feed_page(
+        get_read_db().cursor(), session["user_id"], cursor, feed_stale_for_viewer()
     )
 
+    return Response(dump_json({
+        "fields": fields,
+        "posts": [[get(p) for get in getters] for p in posts],
+        "next_cursor": next_cursor
+    }), mimetype="application/json")
+
 @app.route("/edit/<int:post_id>", methods=["GET", "POST"])
 def edit_post(post_id):
     if "user_id" not in session:
@@ -637,7 +2080,6 @@ def edit_post(post_id):
     row = cur.fetchone()
 
     if not row:
-        db.close()
         return redirect("/feed")
 
     post = {
@@ -650,134 +2092,184 @@ def edit_post(post_id):
         new_content = request.form["content"]
         is_public = int(request.form["is_public"])
 
+        check_censor(cur)
         cur.execute(
-            "UPDATE posts SET content=%s, is_public=%s WHERE id=%s",
-            (new_content, is_public, post_id)
+            """
+            UPDATE posts
+            SET content=%s, rendered_html=%s, render_version=%s, is_public=%s
+            WHERE id=%s
+            """,
+            (new_content, render_post(new_content), RENDER_VERSION, is_public, post_id)
         )
         db.commit()
-        db.close()
+        clear_feed_cache()
         return redirect("/feed")
 
-    db.close()
     return render_template("edit.html", post=post)
 
-@app.route("/delete/<int:post_id>", methods=["POST"])
-def delete_post(post_id):
-    if "user_id" not in session:
-        return {"error": "unauthorized"}, 401
-
-    db = get_db()
-    cur = db.cursor()
-
-    cur.execute("SELECT user_id, type FROM posts WHERE id=%s", (post_id,))
-    post = cur.fetchone()
+def remove_post(cur, user_id, post_id):
+    # Likes, votes, options and the poll go with the post through the
+    # cascading foreign keys from migration 8. The count subquery sees the
+    # table before the delete, hence the adjustment.
+    cur.execute("""
+        WITH target AS (
+            SELECT id, user_id FROM posts WHERE id = %(post)s
+        ), deleted AS (
+            DELETE FROM posts p USING target t
+            WHERE p.id = t.id AND (t.user_id = %(user)s OR %(admin)s)
+            RETURNING p.user_id
+        )
+        SELECT
+            EXISTS (SELECT 1 FROM deleted),
+            (SELECT COUNT(*) FROM posts WHERE user_id = %(user)s)
+                - (SELECT COUNT(*) FROM deleted WHERE user_id = %(user)s)
+        FROM target
+    """, {"post": post_id, "user": user_id, "admin": is_admin_user(user_id)})
+    row = cur.fetchone()
 
-    if not post:
+    if not row:
         return {"error": "not found"}, 404
 
-    post_user_id, post_type = post
-
-    if not is_admin_user(session["user_id"]) and post_user_id != session["user_id"]:
+    deleted, post_count = row
+    if not deleted:
         return {"error": "forbidden"}, 403
 
-    # delete likes
-    cur.execute("DELETE FROM likes WHERE post_id=%s", (post_id,))
+    return {
+        "success": True,
+        "post_count": post_count
+    }, 200
 
-    if post_type == "poll":
-        # delete votes → options → poll
-        cur.execute("""
-            DELETE FROM poll_votes
-            WHERE option_id IN (
-                SELECT id FROM poll_options WHERE post_id=%s
-            )
-        """, (post_id,))
+@app.route("/delete/<int:post_id>", methods=["POST"])
+def delete_post(post_id):
+    if "user_id" not in session:
+        return {"error": "unauthorized"}, 401
+
+    db = get_db()
+    result = remove_post(db.cursor(), session["user_id"], post_id)
+    db.commit()
+    clear_feed_cache()
+    return result
+
+BATCH_MAX_OPS = 50
+BATCH_ACTIONS = {
+    "like": toggle_like,
+    "vote": toggle_vote,
+    "delete": remove_post
+}
+
+@app.route("/api/batch", methods=["POST"])
+def batch():
+    # {"ops": [{"op": "like", "id": 12}, ...]} -> {"results": [...]} in the
+    # same order, each result carrying its own status. Operations run in
+    # order in one transaction, so a like toggled twice ends up unchanged.
+    if "user_id" not in session:
+        return {"error": "unauthorized"}, 401
 
-        cur.execute("DELETE FROM poll_options WHERE post_id=%s", (post_id,))
-        cur.execute("DELETE FROM polls WHERE post_id=%s", (post_id,))
+    payload = request.get_json(silent=True)
+    ops = payload.get("ops") if isinstance(payload, dict) else None
+    if not isinstance(ops, list) or not ops:
+        return {"error": "no operations"}, 400
+    if len(ops) > BATCH_MAX_OPS:
+        return {"error": f"at most {BATCH_MAX_OPS} operations"}, 400
 
-    # finally delete post
-    cur.execute("DELETE FROM posts WHERE id=%s", (post_id,))
+    db = get_db()
+    cur = db.cursor()
+    results = []
+    removed = False
+
+    for op in ops:
+        name = op.get("op") if isinstance(op, dict) else None
+        action = BATCH_ACTIONS.get(name) if isinstance(name, str) else None
+        target = op.get("id") if isinstance(op, dict) else None
+        if (
+            action is None or not isinstance(target, int) or isinstance(target, bool)
+            or not 0 < target <= MAX_ID
+        ):
+            results.append({"error": "invalid operation", "status": 400})
+            continue
+
+        # A failing operation is undone on its own and reported in its slot.
+        # Reusing the name stacks savepoints, and ROLLBACK TO picks the newest.
+        cur.execute("SAVEPOINT batch_op")
+        try:
+            body, status = action(cur, session["user_id"], target)
+        except psycopg2.Error:
+            app.logger.exception("batch %s %s failed", name, target)
+            cur.execute("ROLLBACK TO SAVEPOINT batch_op")
+            body, status = {"error": "operation failed"}, 500
+        results.append(dict(body, status=status))
+        # Likes and votes reach the feed through the overlay's counters;
+        # only a removed post changes what the cached pages list
+        removed = removed or (name == "delete" and status == 200)
 
     db.commit()
-    db.close()
-
-    return {
-        "success": True,
-        "post_count": get_post_count(session["user_id"])
-    }
+    if removed:
+        clear_feed_cache()
+    return {"results": results}
+
+register_statement("profile_user", """
+    SELECT id, username, is_muted, revision FROM users
+    WHERE username = %(username)s AND is_deleted = 0
+""", {"username": "bob"}, username="text")
+
+register_statement("profile_version", """
+    SELECT COUNT(*), MAX(revision) FROM posts WHERE user_id = %(user)s
+""", {"user": 1}, user="integer")
+
+register_statement("profile_posts", """
+    SELECT
+        p.id,
+        p.content,
+        p.rendered_html,
+        p.render_version,
+        p.created_at,
+        p.type,
+        p.like_count
+    FROM posts p
+    WHERE p.user_id = %(user)s
+    ORDER BY p.created_at DESC
+""", {"user": 1}, user="integer")
 
 @app.route("/api/user/<username>")
 def get_user_profile(username):
-    db = get_db()
+    db = get_read_db()
     cur = db.cursor()
 
-    cur.execute(
-        "SELECT id, username, is_muted FROM users WHERE username=%s AND is_deleted=0",
-        (username,)
-    )
-
+    execute_prepared(cur, "profile_user", {"username": username})
     user = cur.fetchone()
     if not user:
         return {"error": "not found"}, 404
 
     user_id = user[0]
 
-    cur.execute("SELECT COUNT(*) FROM posts WHERE user_id=%s", (user_id,))
-    post_count = cur.fetchone()[0]
-
-    cur.execute("""
-        SELECT
-            p.id,
-            p.content,
-            p.created_at,
-            p.type,
-            COUNT(l.post_id) AS likes
-        FROM posts p
-        LEFT JOIN likes l ON l.post_id = p.id
-        WHERE p.user_id=%s
-        GROUP BY p.id
-        ORDER BY p.created_at DESC
-    """, (user_id,))
+    execute_prepared(cur, "profile_version", {"user": user_id})
+    post_count, posts_revision = cur.fetchone()
 
-    rows = cur.fetchall()
-    IST = timezone(timedelta(hours=5, minutes=30))
-    posts = []
+    # Likes and votes land on the post row, so they move posts_revision too
+    etag = make_etag(
+        "profile", session.get("user_id"), user[3], post_count, posts_revision, RENDER_VERSION
+    )
+    cached = not_modified(etag)
+    if cached:
+        return cached
 
-    for r in rows:
-        post_id, content, created_at, ptype, likes = r
-        dt_obj = datetime.fromisoformat(str(created_at)) if isinstance(created_at, str) else created_at
-        time_str = dt_obj.astimezone(IST).strftime("%d/%m/%Y - %I:%M %p").lower()
+    execute_prepared(cur, "profile_posts", {"user": user_id})
 
-        post = {
+    posts = [
+        {
             "id": post_id,
             "type": ptype,
-            "time": time_str,
+            "content": content,
+            "rendered_html": rendered_html,
+            "render_version": render_version,
+            "created_at": created_at,
             "like_count": likes
         }
+        for post_id, content, rendered_html, render_version, created_at, ptype, likes in cur.fetchall()
+    ]
+    hydrate_posts(cur, posts, session.get("user_id"))
 
-        if ptype == "poll":
-            cur.execute("SELECT question FROM polls WHERE post_id=%s", (post_id,))
-            post["question"] = cur.fetchone()[0]
-
-            cur.execute("""
-                SELECT option_text, COUNT(pv.user_id)
-                FROM poll_options po
-                LEFT JOIN poll_votes pv ON pv.option_id = po.id
-                WHERE po.post_id=%s
-                GROUP BY po.id
-            """, (post_id,))
-            post["options"] = [
-                {"text": o[0], "votes": o[1]}
-                for o in cur.fetchall()
-            ]
-        else:
-            post["content"] = render_post(content)
-
-        posts.append(post)
-
-    db.close()
-
-    return {
+    return tagged(jsonify({
         "user": {
             "id": user_id,
             "username": user[1],
@@ -786,7 +2278,7 @@ def get_user_profile(username):
             "is_muted": bool(user[2])
         },
         "posts": posts
-    }
+    }), etag)
 
 @app.route("/admin/mute/<int:user_id>", methods=["POST"])
 def toggle_mute(user_id):
@@ -799,7 +2291,6 @@ def toggle_mute(user_id):
     cur.execute("SELECT is_muted FROM users WHERE id=%s", (user_id,))
     row = cur.fetchone()
     if not row:
-        db.close()
         return {"error": "not found"}, 404
 
     new_state = 0 if row[0] else 1
@@ -809,18 +2300,47 @@ def toggle_mute(user_id):
     )
 
     db.commit()
-    db.close()
+    forget_user(user_id)
 
     return {"muted": bool(new_state)}
 
+register_statement("admin_version", """
+    SELECT
+        (SELECT MAX(revision) FROM users),
+        (SELECT COUNT(*) FROM posts WHERE is_public = 0),
+        (SELECT MAX(revision) FROM posts WHERE is_public = 0)
+""", {})
+
+register_statement("admin_private_posts", """
+    SELECT
+        p.id,
+        p.content,
+        p.rendered_html,
+        p.render_version,
+        p.created_at,
+        p.type,
+        u.username,
+        p.like_count
+    FROM posts p
+    JOIN users u ON p.user_id = u.id
+    WHERE p.is_public = 0
+    ORDER BY p.created_at DESC
+""", {})
+
 @app.route("/admin/panel")
 def admin_panel():
     if "user_id" not in session or not is_admin_user(session["user_id"]):
         return {"error": "forbidden"}, 403
 
-    db = get_db()
+    db = get_read_db()
     cur = db.cursor()
 
+    execute_prepared(cur, "admin_version", {})
+    etag = make_etag("admin_panel", session["user_id"], *cur.fetchone(), RENDER_VERSION)
+    cached = not_modified(etag)
+    if cached:
+        return cached
+
     cur.execute("""
         SELECT id, username, is_muted
         FROM users
@@ -832,64 +2352,41 @@ def admin_panel():
         for u in cur.fetchall()
     ]
 
-    cur.execute("""
-        SELECT
-            p.id,
-            p.content,
-            p.created_at,
-            p.type,
-            u.username,
-            COUNT(l.post_id) AS likes
-        FROM posts p
-        JOIN users u ON p.user_id = u.id
-        LEFT JOIN likes l ON l.post_id = p.id
-        WHERE p.is_public = 0
-        GROUP BY p.id, u.username
-        ORDER BY p.created_at DESC
-    """)
-    IST = timezone(timedelta(hours=5, minutes=30))
-    private_posts = []
-    
-    for r in cur.fetchall():
-        post_id, content, created_at, ptype, username, likes = r
-        dt_obj = datetime.fromisoformat(str(created_at)) if isinstance(created_at, str) else created_at
-        time_str = dt_obj.astimezone(IST).strftime("%d/%m/%Y - %I:%M %p").lower()
-    
-        post = {
+    execute_prepared(cur, "admin_private_posts", {})
+    private_posts = [
+        {
             "id": post_id,
             "type": ptype,
             "username": username,
-            "time": time_str,
+            "content": content,
+            "rendered_html": rendered_html,
+            "render_version": render_version,
+            "created_at": created_at,
             "like_count": likes,
             "readonly": True
         }
-    
-        if ptype == "poll":
-            cur.execute("SELECT question FROM polls WHERE post_id=%s", (post_id,))
-            post["question"] = cur.fetchone()[0]
-    
-            cur.execute("""
-                SELECT option_text, COUNT(pv.user_id)
-                FROM poll_options po
-                LEFT JOIN poll_votes pv ON pv.option_id = po.id
-                WHERE po.post_id=%s
-                GROUP BY po.id
-            """, (post_id,))
-    
-            post["options"] = [
-                {"text": o[0], "votes": o[1]}
-                for o in cur.fetchall()
-            ]
-        else:
-            post["content"] = render_post(content)
-    
-        private_posts.append(post)
-
-    db.close()
+        for post_id, content, rendered_html, render_version, created_at, ptype, username, likes in cur.fetchall()
+    ]
+    hydrate_posts(cur, private_posts, session["user_id"])
 
-    return {
+    return tagged(jsonify({
         "users": users,
         "private_posts": private_posts
+    }), etag)
+
+@app.route("/admin/metrics")
+def admin_metrics():
+    if "user_id" not in session or not is_admin_user(session["user_id"]):
+        return {"error": "forbidden"}, 403
+
+    with _metrics_lock:
+        routes = json.loads(json.dumps(_route_metrics))
+
+    return {
+        "latency_buckets_ms": LATENCY_BUCKETS_MS,
+        "query_buckets": QUERY_BUCKETS,
+        "repeated_query_threshold": REPEATED_QUERY_THRESHOLD,
+        "routes": routes
     }
 
 @app.route("/admin/curse", methods=["POST"])
@@ -908,8 +2405,18 @@ def add_curse():
         "INSERT INTO curse_words(word) VALUES (%s) ON CONFLICT (word) DO NOTHING",
         (word,)
     )
+    # Only posts that mention the word need their stored HTML redone
+    cur.execute(
+        """
+        UPDATE posts SET render_version = NULL
+        WHERE type = 'text' AND position(%s IN lower(content)) > 0
+        """,
+        (word,)
+    )
     db.commit()
-    db.close()
+    refresh_censor()
+    clear_feed_cache()
+    rerender_in_background()
 
     return {"success": True}
 
@@ -935,7 +2442,6 @@ def change_username():
     row = cur.fetchone()
 
     if not row or row[0] != hash_password(password):
-        db.close()
         return {"error": "wrong password"}, 403
 
     cur.execute(
@@ -943,7 +2449,6 @@ def change_username():
         (new_username,)
     )
     if cur.fetchone():
-        db.close()
         return {"error": "username already taken"}, 400
 
     cur.execute(
@@ -952,8 +2457,10 @@ def change_username():
     )
 
     db.commit()
-    db.close()
 
+    forget_user(session["user_id"])
+    clear_search_cache()
+    clear_feed_cache()
     session["username"] = new_username
     return {"success": True}
 
@@ -979,11 +2486,9 @@ def change_password():
     row = cur.fetchone()
 
     if not row:
-        db.close()
         return {"error": "user not found"}, 404
 
     if row[0] != hash_password(old):
-        db.close()
         return {"error": "wrong password"}, 403
 
     cur.execute(
@@ -992,7 +2497,6 @@ def change_password():
     )
 
     db.commit()
-    db.close()
     return {"success": True}
 
 @app.route("/account/delete", methods=["POST"])
@@ -1002,7 +2506,7 @@ def delete_account():
 
     user_id = session["user_id"]
     db = get_db()
-    cur = cursor()
+    cur = db.cursor()
 
     cur.execute(
         """
@@ -1016,7 +2520,9 @@ def delete_account():
     )
 
     db.commit()
-    db.close()
+    forget_user(user_id)
+    clear_search_cache()
+    clear_feed_cache()
 
     session.clear()
     return {"success": True}
@@ -1026,13 +2532,21 @@ def logout():
     session.clear()
     return redirect("/")
 
-def get_post_count(user_id):
-    db = get_db()
-    cur = db.cursor()
-    cur.execute("SELECT COUNT(*) FROM posts WHERE user_id=%s", (user_id,))
-    count = cur.fetchone()[0]
-    db.close()
-    return count
+@app.cli.command("migrate")
+def migrate_command():
+    """Create or upgrade the database schema and indexes."""
+    applied = migrations.migrate(get_db())
+    print(f"applied migrations: {applied}" if applied else "schema is up to date")
+
+@app.cli.command("check-plans")
+def check_plans_command():
+    """Fail if any prepared hot query falls back to a sequential scan."""
+    failures = migrations.check_plans(get_db(), PREPARED)
+    for name, tables in failures:
+        print(f"SEQ SCAN  {name}: {', '.join(tables)}")
+    if failures:
+        raise SystemExit(1)
+    print(f"all {len(PREPARED)} hot queries use indexes")
 
 if __name__ == "__main__":
     app.run(debug=True, host='0.0.0.0')
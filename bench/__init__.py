@@ -0,0 +1,3 @@
+# --- BENCHMARKS ---
+# Seeds a local PostgreSQL with synthetic data and drives the hot routes
+# through the Flask app. Run with: python -m bench --help
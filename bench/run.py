@@ -0,0 +1,257 @@
+# Drives the hot routes through the Flask test client against a real
+# PostgreSQL and reports throughput, latency percentiles and queries per
+# request as JSON, so runs can be diffed across commits.
+
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+from psycopg2 import pool
+
+import app
+import migrations
+from bench.seed import DEFAULT_VOLUMES, seed
+
+class CountingCursor(app.InstrumentedCursor):
+    # Every statement the app sends, across all pooled connections
+    executed = 0
+    lock = threading.Lock()
+
+    def execute(self, query, vars=None):
+        with CountingCursor.lock:
+            CountingCursor.executed += 1
+        return super().execute(query, vars)
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    k = (len(sorted_values) - 1) * p / 100
+    lo = int(k)
+    hi = min(lo + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo)
+
+def summarize(name, timings, queries, errors, wall):
+    ms = sorted(t * 1000 for t in timings)
+    return {
+        "scenario": name,
+        "requests": len(timings),
+        "errors": errors,
+        "seconds": round(wall, 4),
+        "throughput_rps": round(len(timings) / wall, 2) if wall else None,
+        "p50_ms": round(percentile(ms, 50), 3) if ms else None,
+        "p95_ms": round(percentile(ms, 95), 3) if ms else None,
+        "p99_ms": round(percentile(ms, 99), 3) if ms else None,
+        "queries_per_request": round(queries / len(timings), 2) if timings else None
+    }
+
+def login(client, user_id, username):
+    with client.session_transaction() as s:
+        s["user_id"] = user_id
+        s["username"] = username
+
+def discover(db):
+    # Ids to exercise when running against an existing database
+    cur = db.cursor()
+    cur.execute("SELECT id FROM users WHERE is_deleted = 0 ORDER BY id")
+    user_ids = [r[0] for r in cur.fetchall()]
+    cur.execute("SELECT id FROM posts ORDER BY id")
+    post_ids = [r[0] for r in cur.fetchall()]
+    cur.execute("SELECT id FROM poll_options ORDER BY id")
+    option_ids = [r[0] for r in cur.fetchall()]
+    cur.execute("""
+        SELECT sender_id, receiver_id FROM messages
+        GROUP BY sender_id, receiver_id
+        ORDER BY COUNT(*) DESC
+        LIMIT 50
+    """)
+    heavy = [tuple(r) for r in cur.fetchall()]
+    db.rollback()
+    return {
+        "user_ids": user_ids,
+        "post_ids": post_ids,
+        "option_ids": option_ids,
+        "heavy_pairs": heavy
+    }
+
+def usernames(db, user_ids):
+    cur = db.cursor()
+    cur.execute("SELECT id, username FROM users WHERE id = ANY(%s)", (user_ids,))
+    names = dict(cur.fetchall())
+    db.rollback()
+    return names
+
+def run_requests(name, n, make_request):
+    timings = []
+    errors = 0
+    before = CountingCursor.executed
+    started = time.perf_counter()
+    for i in range(n):
+        t0 = time.perf_counter()
+        status = make_request(i)
+        timings.append(time.perf_counter() - t0)
+        if status >= 400:
+            errors += 1
+    wall = time.perf_counter() - started
+    return summarize(name, timings, CountingCursor.executed - before, errors, wall)
+
+def run_stream(n, rng, data, names):
+    # Latency from send_message() returning to the receiver's SSE stream
+    # yielding the message, i.e. the NOTIFY fan-out path
+    timings = []
+    errors = 0
+    before = CountingCursor.executed
+    started = time.perf_counter()
+
+    for _ in range(n):
+        sender, receiver = rng.choice(data["heavy_pairs"])
+        listener = app.app.test_client()
+        login(listener, receiver, names.get(receiver))
+        talker = app.app.test_client()
+        login(talker, sender, names.get(sender))
+
+        got = {}
+
+        def read():
+            # The test client blocks until the stream yields its first
+            # chunk, so the request itself is made on the reader thread
+            response = listener.get("/api/stream_messages", buffered=False)
+            got["response"] = response
+            for chunk in response.response:
+                if b'"sender"' in chunk:
+                    got["at"] = time.perf_counter()
+                    return
+
+        reader = threading.Thread(target=read, daemon=True)
+        reader.start()
+
+        deadline = time.monotonic() + 5
+        while receiver not in app._subscribers and time.monotonic() < deadline:
+            time.sleep(0.001)
+        # Let the start-up catch-up query finish before sending
+        time.sleep(0.01)
+
+        t0 = time.perf_counter()
+        sent = talker.post("/api/send_message", data={
+            "receiver_id": receiver,
+            "content": "bench ping"
+        })
+        reader.join(timeout=10)
+        if "response" in got:
+            got["response"].close()
+
+        if sent.status_code >= 400 or "at" not in got:
+            errors += 1
+            continue
+        timings.append(got["at"] - t0)
+
+    wall = time.perf_counter() - started
+    return summarize("stream_messages", timings, CountingCursor.executed - before, errors, wall)
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m bench",
+        description="Benchmark DaBlog's hot routes against DATABASE_URL."
+    )
+    parser.add_argument("--seed", action="store_true",
+                        help="WIPE the database and load synthetic data first")
+    for key, value in DEFAULT_VOLUMES.items():
+        parser.add_argument(f"--{key.replace('_', '-')}", type=type(value), default=value)
+    parser.add_argument("--requests", type=int, default=200, help="requests per scenario")
+    parser.add_argument("--stream-requests", type=int, default=20)
+    parser.add_argument("--rng-seed", type=int, default=1)
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args(argv)
+
+    if not app.DATABASE_URL:
+        sys.exit("DATABASE_URL must point at a disposable local database")
+
+    app._db_pools["primary"] = pool.ThreadedConnectionPool(
+        app.DB_POOL_MIN, app.DB_POOL_MAX, app.DATABASE_URL,
+        connection_factory=app.AppConnection,
+        cursor_factory=CountingCursor
+    )
+    volumes = {key: getattr(args, key) for key in DEFAULT_VOLUMES}
+    rng = random.Random(args.rng_seed)
+
+    with app.app.app_context():
+        db = app.get_db()
+        migrations.migrate(db)
+        if args.seed:
+            data = seed(db, volumes, args.rng_seed)
+        else:
+            data = discover(db)
+        if not data["user_ids"] or not data["post_ids"]:
+            sys.exit("no data to benchmark; run with --seed")
+        names = usernames(db, data["user_ids"])
+
+    def client_for(user_id):
+        client = app.app.test_client()
+        login(client, user_id, names.get(user_id))
+        return client
+
+    def get(path_for):
+        def make(i):
+            user_id = rng.choice(data["user_ids"])
+            # buffered: streamed pages (e.g. /feed) only run their queries
+            # while the body is read
+            return client_for(user_id).get(path_for(user_id), buffered=True).status_code
+        return make
+
+    def post(path_for, choices):
+        def make(i):
+            user_id = rng.choice(data["user_ids"])
+            return client_for(user_id).post(path_for(rng.choice(choices))).status_code
+        return make
+
+    def partner(user_id):
+        for a, b in data["heavy_pairs"]:
+            if a == user_id:
+                return b
+            if b == user_id:
+                return a
+        return rng.choice(data["user_ids"])
+
+    n = args.requests
+    results = [
+        run_requests("feed", n, get(lambda u: "/feed")),
+        run_requests("user_profile", n, get(lambda u: f"/api/user/{names[rng.choice(data['user_ids'])]}")),
+        run_requests("like", n, post(lambda p: f"/like/{p}", data["post_ids"])),
+        run_requests("dm_list", n, get(lambda u: "/api/dm_list")),
+        run_requests("get_messages", n, get(lambda u: f"/api/get_messages/{partner(u)}")),
+    ]
+    if data["option_ids"]:
+        results.insert(3, run_requests("vote", n, post(lambda o: f"/vote/{o}", data["option_ids"])))
+    if data["heavy_pairs"] and args.stream_requests:
+        results.append(run_stream(args.stream_requests, rng, data, names))
+
+    report = {
+        "commit": git_commit(),
+        "ran_at": datetime.now(timezone.utc).isoformat(),
+        "seeded": args.seed,
+        "volumes": volumes,
+        "pool": {"min": app.DB_POOL_MIN, "max": app.DB_POOL_MAX},
+        "results": results
+    }
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
@@ -0,0 +1,151 @@
+# Synthetic data for the benchmarks. Everything is drawn from one seeded
+# random.Random so two runs with the same volumes produce the same database.
+
+import random
+from datetime import datetime, timezone, timedelta
+from psycopg2.extras import execute_values
+
+import app
+
+WORDS = (
+    "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod "
+    "tempor incididunt ut labore et dolore magna aliqua www.example.com "
+    "[b]bold[/b] [i]slanted[/i] https://dablog.example/post"
+).split()
+
+TABLES = [
+    "conversations", "messages", "poll_votes", "poll_options", "polls",
+    "likes", "posts", "curse_words", "users"
+]
+
+DEFAULT_VOLUMES = {
+    "users": 500,
+    "posts": 5000,
+    "likes": 20000,
+    "poll_ratio": 0.1,
+    "votes": 5000,
+    "messages": 20000,
+    "curse_words": 200
+}
+
+def sentence(rng, n):
+    return " ".join(rng.choice(WORDS) for _ in range(n))
+
+def seed(db, volumes, rng_seed=1):
+    """Wipes the app tables and fills them according to `volumes`."""
+    rng = random.Random(rng_seed)
+    cur = db.cursor()
+    cur.execute(f"TRUNCATE {', '.join(TABLES)} RESTART IDENTITY CASCADE")
+
+    password = app.hash_password("bench")
+    execute_values(
+        cur,
+        "INSERT INTO users (username, password) VALUES %s",
+        [(f"bench_user_{i}", password) for i in range(volumes["users"])],
+        page_size=1000
+    )
+    user_ids = list(range(1, volumes["users"] + 1))
+
+    execute_values(
+        cur,
+        "INSERT INTO curse_words (word) VALUES %s ON CONFLICT DO NOTHING",
+        [(f"badword{i}",) for i in range(volumes["curse_words"])],
+        page_size=1000
+    )
+
+    # Posts spread over the last 90 days, a share of them polls or private
+    now = datetime.now(timezone.utc)
+    posts = []
+    for _ in range(volumes["posts"]):
+        is_poll = rng.random() < volumes["poll_ratio"]
+        posts.append((
+            rng.choice(user_ids),
+            "" if is_poll else sentence(rng, rng.randint(5, 80)),
+            now - timedelta(seconds=rng.randint(0, 90 * 86400)),
+            0 if rng.random() < 0.05 else 1,
+            "poll" if is_poll else "text"
+        ))
+    execute_values(
+        cur,
+        "INSERT INTO posts (user_id, content, created_at, is_public, type) VALUES %s",
+        posts,
+        page_size=1000
+    )
+    post_ids = list(range(1, len(posts) + 1))
+    poll_ids = [pid for pid, p in zip(post_ids, posts) if p[4] == "poll"]
+
+    execute_values(
+        cur,
+        "INSERT INTO polls (post_id, question) VALUES %s",
+        [(pid, sentence(rng, 6) + "?") for pid in poll_ids],
+        page_size=1000
+    )
+    options = [
+        (pid, sentence(rng, 2))
+        for pid in poll_ids
+        for _ in range(rng.randint(2, 5))
+    ]
+    execute_values(
+        cur,
+        "INSERT INTO poll_options (post_id, option_text) VALUES %s",
+        options,
+        page_size=1000
+    )
+    options_by_poll = {}
+    for option_id, (pid, _) in enumerate(options, start=1):
+        options_by_poll.setdefault(pid, []).append(option_id)
+
+    # Likes skew towards recent posts so some get "viral"
+    likes = set()
+    target = min(volumes["likes"], len(user_ids) * len(post_ids))
+    while len(likes) < target:
+        post = int(len(post_ids) * rng.random() ** 3) + 1
+        likes.add((rng.choice(user_ids), post))
+    execute_values(cur, "INSERT INTO likes (user_id, post_id) VALUES %s", list(likes), page_size=1000)
+
+    # One vote per (user, poll)
+    votes = {}
+    if poll_ids:
+        target = min(volumes["votes"], len(user_ids) * len(poll_ids))
+        while len(votes) < target:
+            pid = rng.choice(poll_ids)
+            votes[(rng.choice(user_ids), pid)] = rng.choice(options_by_poll[pid])
+    execute_values(
+        cur,
+        "INSERT INTO poll_votes (user_id, option_id) VALUES %s",
+        [(uid, oid) for (uid, _), oid in votes.items()],
+        page_size=1000
+    )
+
+    # DMs: most traffic between a few heavy pairs, the rest scattered
+    heavy = [tuple(rng.sample(user_ids, 2)) for _ in range(max(1, len(user_ids) // 20))]
+    messages = []
+    for i in range(volumes["messages"]):
+        pair = rng.choice(heavy) if rng.random() < 0.7 else tuple(rng.sample(user_ids, 2))
+        if rng.random() < 0.5:
+            pair = pair[::-1]
+        messages.append((
+            pair[0], pair[1], sentence(rng, rng.randint(1, 20)),
+            now - timedelta(seconds=volumes["messages"] - i)
+        ))
+    # Ids restart at 1, so large volumes may need partitions past the spare
+    app.ensure_message_partitions(cur, len(messages))
+    execute_values(
+        cur,
+        "INSERT INTO messages (sender_id, receiver_id, content, created_at) VALUES %s",
+        messages,
+        page_size=1000
+    )
+    db.commit()
+
+    # Derived data goes through the app's own maintenance paths
+    app.recount_counters()
+    app.rebuild_conversations()
+    app.rerender_stale_posts()
+
+    return {
+        "user_ids": user_ids,
+        "post_ids": post_ids,
+        "option_ids": list(range(1, len(options) + 1)),
+        "heavy_pairs": heavy
+    }
@@ -0,0 +1,329 @@
+# --- SCHEMA MIGRATIONS ---
+# Versioned schema for DaBlog. Each migration runs once, in order, inside its
+# own transaction, and is recorded in schema_migrations. Statements are written
+# to be safe on databases that were created by hand before this file existed.
+# Run with `flask migrate`; `flask check-plans` verifies the hot queries below
+# are served by indexes.
+
+import json
+
+# Ids per messages partition (migration 9). Fixed once partitions exist;
+# app.py creates new ones of the same width as ids grow.
+MESSAGE_PARTITION_SIZE = 1000000
+
+MIGRATIONS = [
+    (1, "base schema", """
+        CREATE TABLE IF NOT EXISTS users (
+            id SERIAL PRIMARY KEY,
+            username TEXT UNIQUE,
+            password TEXT NOT NULL,
+            is_muted INTEGER NOT NULL DEFAULT 0,
+            is_deleted INTEGER NOT NULL DEFAULT 0,
+            deleted_username TEXT
+        );
+
+        CREATE TABLE IF NOT EXISTS posts (
+            id SERIAL PRIMARY KEY,
+            user_id INTEGER NOT NULL REFERENCES users(id),
+            content TEXT NOT NULL DEFAULT '',
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            is_public INTEGER NOT NULL DEFAULT 1,
+            type TEXT NOT NULL DEFAULT 'text'
+        );
+
+        CREATE TABLE IF NOT EXISTS likes (
+            user_id INTEGER NOT NULL REFERENCES users(id),
+            post_id INTEGER NOT NULL REFERENCES posts(id),
+            PRIMARY KEY (user_id, post_id)
+        );
+
+        CREATE TABLE IF NOT EXISTS polls (
+            post_id INTEGER PRIMARY KEY REFERENCES posts(id),
+            question TEXT NOT NULL
+        );
+
+        CREATE TABLE IF NOT EXISTS poll_options (
+            id SERIAL PRIMARY KEY,
+            post_id INTEGER NOT NULL REFERENCES posts(id),
+            option_text TEXT NOT NULL
+        );
+
+        CREATE TABLE IF NOT EXISTS poll_votes (
+            user_id INTEGER NOT NULL REFERENCES users(id),
+            option_id INTEGER NOT NULL REFERENCES poll_options(id),
+            PRIMARY KEY (user_id, option_id)
+        );
+
+        CREATE TABLE IF NOT EXISTS messages (
+            id SERIAL PRIMARY KEY,
+            sender_id INTEGER NOT NULL REFERENCES users(id),
+            receiver_id INTEGER NOT NULL REFERENCES users(id),
+            content TEXT NOT NULL,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+
+        CREATE TABLE IF NOT EXISTS curse_words (
+            word TEXT PRIMARY KEY
+        );
+
+        ALTER TABLE messages ADD COLUMN IF NOT EXISTS created_at TIMESTAMPTZ NOT NULL DEFAULT now();
+    """),
+
+    (2, "hot path indexes", """
+        CREATE INDEX IF NOT EXISTS posts_created_at_id ON posts (created_at, id);
+        CREATE INDEX IF NOT EXISTS posts_user_created_at ON posts (user_id, created_at);
+        CREATE INDEX IF NOT EXISTS posts_private_created_at ON posts (created_at) WHERE is_public = 0;
+        CREATE INDEX IF NOT EXISTS likes_post_id ON likes (post_id);
+        CREATE INDEX IF NOT EXISTS poll_options_post_id ON poll_options (post_id);
+        CREATE INDEX IF NOT EXISTS poll_votes_option_id ON poll_votes (option_id);
+        CREATE INDEX IF NOT EXISTS messages_receiver_id ON messages (receiver_id, id);
+        CREATE INDEX IF NOT EXISTS messages_pair_id ON messages (sender_id, receiver_id, id);
+    """),
+
+    (3, "stored post html", """
+        ALTER TABLE posts ADD COLUMN IF NOT EXISTS rendered_html TEXT;
+        ALTER TABLE posts ADD COLUMN IF NOT EXISTS render_version INTEGER;
+    """),
+
+    (4, "like and vote counters", """
+        ALTER TABLE posts ADD COLUMN IF NOT EXISTS like_count INTEGER NOT NULL DEFAULT 0;
+        ALTER TABLE poll_options ADD COLUMN IF NOT EXISTS vote_count INTEGER NOT NULL DEFAULT 0;
+
+        UPDATE posts p SET like_count = c.n
+        FROM (SELECT post_id, COUNT(*) AS n FROM likes GROUP BY post_id) c
+        WHERE p.id = c.post_id;
+
+        UPDATE poll_options po SET vote_count = c.n
+        FROM (SELECT option_id, COUNT(*) AS n FROM poll_votes GROUP BY option_id) c
+        WHERE po.id = c.option_id;
+    """),
+
+    (5, "conversation summaries", """
+        CREATE TABLE IF NOT EXISTS conversations (
+            user_id INTEGER NOT NULL REFERENCES users(id),
+            partner_id INTEGER NOT NULL REFERENCES users(id),
+            last_message_id INTEGER,
+            last_preview TEXT,
+            last_at TIMESTAMPTZ,
+            unread_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, partner_id)
+        );
+
+        CREATE INDEX IF NOT EXISTS conversations_user_last_at ON conversations (user_id, last_at DESC);
+
+        INSERT INTO conversations
+            (user_id, partner_id, last_message_id, last_preview, last_at, unread_count)
+        SELECT DISTINCT ON (pair.user_id, pair.partner_id)
+            pair.user_id, pair.partner_id, m.id, LEFT(m.content, 100), m.created_at, 0
+        FROM (
+            SELECT id, sender_id AS user_id, receiver_id AS partner_id FROM messages
+            UNION ALL
+            SELECT id, receiver_id, sender_id FROM messages
+        ) pair
+        JOIN messages m ON m.id = pair.id
+        WHERE pair.user_id != pair.partner_id
+        ORDER BY pair.user_id, pair.partner_id, m.id DESC
+        ON CONFLICT (user_id, partner_id) DO NOTHING;
+    """),
+
+    (6, "trigram user search", """
+        CREATE EXTENSION IF NOT EXISTS pg_trgm;
+        CREATE INDEX IF NOT EXISTS users_username_trgm ON users USING gin (lower(username) gin_trgm_ops);
+    """),
+
+    # Every write to a user or post stamps it with a new value from one global
+    # sequence, so MAX(revision) over any set of rows changes whenever one of
+    # them does. app.py builds ETags from these.
+    (7, "row revisions", """
+        CREATE SEQUENCE IF NOT EXISTS revision_seq;
+        ALTER TABLE users ADD COLUMN IF NOT EXISTS revision BIGINT NOT NULL DEFAULT nextval('revision_seq');
+        ALTER TABLE posts ADD COLUMN IF NOT EXISTS revision BIGINT NOT NULL DEFAULT nextval('revision_seq');
+
+        -- The admin panel's version is MAX(revision) over all users and the private posts
+        CREATE INDEX IF NOT EXISTS users_revision ON users (revision);
+        CREATE INDEX IF NOT EXISTS posts_private_revision ON posts (revision) WHERE is_public = 0;
+
+        CREATE OR REPLACE FUNCTION bump_revision() RETURNS trigger AS $$
+        BEGIN
+            NEW.revision := nextval('revision_seq');
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql;
+
+        -- A vote changes what the poll's post looks like
+        CREATE OR REPLACE FUNCTION bump_poll_revision() RETURNS trigger AS $$
+        BEGIN
+            UPDATE posts SET revision = nextval('revision_seq') WHERE id = NEW.post_id;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql;
+
+        DROP TRIGGER IF EXISTS users_revision ON users;
+        CREATE TRIGGER users_revision BEFORE UPDATE ON users
+            FOR EACH ROW EXECUTE FUNCTION bump_revision();
+
+        DROP TRIGGER IF EXISTS posts_revision ON posts;
+        CREATE TRIGGER posts_revision BEFORE UPDATE ON posts
+            FOR EACH ROW EXECUTE FUNCTION bump_revision();
+
+        DROP TRIGGER IF EXISTS poll_options_revision ON poll_options;
+        CREATE TRIGGER poll_options_revision AFTER UPDATE OF vote_count ON poll_options
+            FOR EACH ROW EXECUTE FUNCTION bump_poll_revision();
+    """),
+
+    # Deleting a post takes its likes, poll, options and votes with it
+    (8, "cascade post deletes", """
+        ALTER TABLE likes DROP CONSTRAINT IF EXISTS likes_post_id_fkey;
+        ALTER TABLE likes ADD CONSTRAINT likes_post_id_fkey
+            FOREIGN KEY (post_id) REFERENCES posts(id) ON DELETE CASCADE;
+
+        ALTER TABLE polls DROP CONSTRAINT IF EXISTS polls_post_id_fkey;
+        ALTER TABLE polls ADD CONSTRAINT polls_post_id_fkey
+            FOREIGN KEY (post_id) REFERENCES posts(id) ON DELETE CASCADE;
+
+        ALTER TABLE poll_options DROP CONSTRAINT IF EXISTS poll_options_post_id_fkey;
+        ALTER TABLE poll_options ADD CONSTRAINT poll_options_post_id_fkey
+            FOREIGN KEY (post_id) REFERENCES posts(id) ON DELETE CASCADE;
+
+        ALTER TABLE poll_votes DROP CONSTRAINT IF EXISTS poll_votes_option_id_fkey;
+        ALTER TABLE poll_votes ADD CONSTRAINT poll_votes_option_id_fkey
+            FOREIGN KEY (option_id) REFERENCES poll_options(id) ON DELETE CASCADE;
+    """),
+
+    # messages becomes range-partitioned on id, MESSAGE_PARTITION_SIZE ids per
+    # partition named messages_p<n>. Every message query filters or orders by
+    # id, so cursors prune to the partitions they touch and old history sits
+    # in its own tables. Existing rows are copied over inside the migration.
+    (9, "partitioned messages", f"""
+        DO $$
+        DECLARE
+            top BIGINT;
+        BEGIN
+            IF EXISTS (
+                SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'messages'::regclass
+            ) THEN
+                RETURN;
+            END IF;
+
+            ALTER TABLE messages RENAME TO messages_unpartitioned;
+            ALTER TABLE messages_unpartitioned RENAME CONSTRAINT messages_pkey TO messages_unpartitioned_pkey;
+            DROP INDEX IF EXISTS messages_receiver_id;
+            DROP INDEX IF EXISTS messages_pair_id;
+            ALTER SEQUENCE messages_id_seq OWNED BY NONE;
+
+            CREATE TABLE messages (
+                id INTEGER NOT NULL DEFAULT nextval('messages_id_seq'),
+                sender_id INTEGER NOT NULL REFERENCES users(id),
+                receiver_id INTEGER NOT NULL REFERENCES users(id),
+                content TEXT NOT NULL,
+                created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                PRIMARY KEY (id)
+            ) PARTITION BY RANGE (id);
+            ALTER SEQUENCE messages_id_seq OWNED BY messages.id;
+
+            -- One spare partition past the newest id
+            SELECT COALESCE(MAX(id), 0) INTO top FROM messages_unpartitioned;
+            FOR n IN 0 .. top / {MESSAGE_PARTITION_SIZE} + 1 LOOP
+                EXECUTE format(
+                    'CREATE TABLE messages_p%s PARTITION OF messages FOR VALUES FROM (%s) TO (%s)',
+                    n, n * {MESSAGE_PARTITION_SIZE}, (n + 1) * {MESSAGE_PARTITION_SIZE}
+                );
+            END LOOP;
+
+            INSERT INTO messages (id, sender_id, receiver_id, content, created_at)
+            SELECT id, sender_id, receiver_id, content, created_at FROM messages_unpartitioned;
+            DROP TABLE messages_unpartitioned;
+        END
+        $$;
+
+        CREATE INDEX IF NOT EXISTS messages_receiver_id ON messages (receiver_id, id);
+        CREATE INDEX IF NOT EXISTS messages_pair_id ON messages (sender_id, receiver_id, id);
+    """),
+]
+
+def applied_versions(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+    """)
+    cur.execute("SELECT version FROM schema_migrations")
+    return {row[0] for row in cur.fetchall()}
+
+def migrate(db):
+    """Applies pending migrations in order; returns the versions applied."""
+    cur = db.cursor()
+    done = applied_versions(cur)
+    db.commit()
+
+    applied = []
+    for version, name, sql in MIGRATIONS:
+        if version in done:
+            continue
+        try:
+            cur.execute(sql)
+            cur.execute(
+                "INSERT INTO schema_migrations (version, name) VALUES (%s, %s)",
+                (version, name)
+            )
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        applied.append(version)
+    return applied
+
+# --- QUERY PLAN CHECKS ---
+# The statements themselves live in app.PREPARED, the registry the handlers
+# execute them from, each with representative parameters.
+
+def seq_scans(plan):
+    """Relations a JSON plan reads with a sequential scan."""
+    found = []
+    if plan.get("Node Type") == "Seq Scan":
+        found.append(plan.get("Relation Name"))
+    for child in plan.get("Plans", []):
+        found.extend(seq_scans(child))
+    return found
+
+def check_plans(db, statements):
+    """
+    Prepares every statement in `statements` (app.PREPARED) and EXPLAINs it
+    with its example parameters, with sequential scans disabled so the
+    planner only picks one when no usable index exists. Both the custom plan
+    and the generic plan a prepared statement settles on are checked.
+    Returns [(name, [tables])] for the statements that still scan.
+    """
+    cur = db.cursor()
+    failures = []
+    prepared = False
+    try:
+        cur.execute("SET LOCAL enable_seqscan = off")
+        for name, statement in statements.items():
+            types = statement["types"]
+            signature = f" ({', '.join(types)})" if types else ""
+            args = f" ({', '.join(['%s'] * len(types))})" if types else ""
+            cur.execute(f"PREPARE plan_check{signature} AS {statement['positional']}")
+            prepared = True
+            for mode in ("auto", "force_generic_plan"):
+                cur.execute(f"SET LOCAL plan_cache_mode = {mode}")
+                cur.execute("EXPLAIN (FORMAT JSON) EXECUTE plan_check" + args, statement["example"])
+                plan = cur.fetchone()[0]
+                if isinstance(plan, str):
+                    plan = json.loads(plan)
+                tables = seq_scans(plan[0]["Plan"])
+                if tables:
+                    label = name if mode == "auto" else f"{name} (generic plan)"
+                    failures.append((label, tables))
+            cur.execute("DEALLOCATE plan_check")
+            prepared = False
+    finally:
+        db.rollback()
+        # PREPARE outlives the rollback. Deallocating only after it means a
+        # failed EXPLAIN surfaces as itself, not as InFailedSqlTransaction.
+        if prepared:
+            cur.execute("DEALLOCATE plan_check")
+            db.rollback()
+    return failures
@@ -0,0 +1,33 @@
+# Cooperative production server. Under gevent every open /api/stream_messages
+# connection is a greenlet parked on its message queue instead of an OS thread,
+# so thousands of idle chat tabs cost memory only.
+#
+#   pip install gevent psycogreen
+#   PORT=8000 python serve.py
+
+import os
+import sys
+
+try:
+    from gevent import monkey
+except ImportError:
+    sys.exit("serve.py needs gevent: pip install gevent psycogreen")
+
+# Must run before anything imports socket, threading or psycopg2
+monkey.patch_all()
+
+try:
+    from psycogreen.gevent import patch_psycopg
+except ImportError:
+    sys.exit("serve.py needs psycogreen so database waits yield: pip install psycogreen")
+
+patch_psycopg()
+
+from gevent.pywsgi import WSGIServer
+
+from app import app
+
+if __name__ == "__main__":
+    port = int(os.getenv("PORT", "8000"))
+    print(f"Serving DaBlog cooperatively on :{port}")
+    WSGIServer(("0.0.0.0", port), app).serve_forever()
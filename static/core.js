@@ -149,6 +149,14 @@ function removeFormatting() {
 function initChatStream() {
     const source = new EventSource("/api/stream_messages");
 
+    // The browser retries dropped streams itself, but gives up for good on
+    // an error response (e.g. 503 when the server is at its stream cap)
+    source.onerror = function() {
+        if (source.readyState === EventSource.CLOSED) {
+            setTimeout(initChatStream, 30000);
+        }
+    };
+
     source.onmessage = function(event) {
         const data = JSON.parse(event.data);
         
@@ -183,8 +191,18 @@ function closeSearch() {
     document.getElementById("search-overlay").classList.add("hidden");
 }
 
-async function performFuzzySearch(q) {
+let searchTimer = null;
+let searchSeq = 0;
+
+// Debounced so a burst of keystrokes costs one request
+function performFuzzySearch(q) {
+    clearTimeout(searchTimer);
+    searchTimer = setTimeout(() => runFuzzySearch(q), 150);
+}
+
+async function runFuzzySearch(q) {
     const resultsDiv = document.getElementById('fuzzy-results');
+    const seq = ++searchSeq;
     if (q.length < 1) {
         resultsDiv.innerHTML = "";
         return;
@@ -192,6 +210,7 @@ async function performFuzzySearch(q) {
 
     const res = await fetch(`/api/search_users?q=${encodeURIComponent(q)}`);
     const data = await res.json();
+    if (seq !== searchSeq) return; // a newer search already went out
     
     resultsDiv.innerHTML = data.users.map(u => `
         <div class="dm-item" onclick="location.href='/chat/${u.username}'">